@@ -0,0 +1,52 @@
+"""
+Run the benchmark scenarios and print the results as JSON.
+
+    python -m benchmarks [--output results.json] [--filter name]
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import platform
+import sys
+
+from .scenarios import SCENARIOS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bonsoir benchmarks")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--filter", help="Only run scenarios containing this name")
+    args = parser.parse_args()
+
+    results = []
+    for name, scenario, params in SCENARIOS:
+        if args.filter and args.filter not in name:
+            continue
+        print("running", name, params, file=sys.stderr)
+        metrics = asyncio.run(scenario(**params))
+        results.append(
+            {
+                "name": name,
+                "params": {key: str(value) for key, value in params.items()},
+                "metrics": metrics,
+            }
+        )
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+
+
+if __name__ == "__main__":
+    main()
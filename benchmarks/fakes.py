@@ -0,0 +1,134 @@
+"""
+In-process stand-ins for itllib and the model backends, so benchmarks measure
+bonsoir itself instead of the network or a model.
+"""
+
+import asyncio
+from collections import defaultdict
+import time
+from types import SimpleNamespace
+
+from bonsoir.metrics import null_metrics
+
+
+class FakeItl:
+    """Implements the parts of itllib.Itl that modules use, entirely in memory."""
+
+    def __init__(self):
+        self.handlers = defaultdict(list)
+        self.sent = defaultdict(int)
+
+    def ondata(self, stream: str):
+        def decorator(handler):
+            self.handlers[stream].append(handler)
+            return handler
+
+        return decorator
+
+    async def stream_send(self, stream: str, data):
+        self.sent[stream] += 1
+
+    async def deliver(self, stream: str, data):
+        """Call every handler for a stream, as itllib would on receiving data."""
+        for handler in self.handlers[stream]:
+            await handler(data)
+
+
+def _split_tokens(text: str, count: int):
+    size = max(1, len(text) // max(count, 1))
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+class FakeOpenAIBackend:
+    """
+    Stands in for OpenAIBackend. Responses take latency seconds plus however long
+    it takes to produce completion_tokens at tokens_per_second.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        tokens_per_second: float = None,
+        completion_tokens: int = 20,
+        response: str = "fake response",
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.response = response
+        self.calls = 0
+        self.metrics = null_metrics
+
+    def _token_delay(self):
+        if not self.tokens_per_second:
+            return 0
+        return 1 / self.tokens_per_second
+
+    async def chat(self, model: str, messages: list, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency + self._token_delay() * self.completion_tokens)
+        prompt_tokens = sum(len(message["content"]) // 4 for message in messages)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.response))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=self.completion_tokens,
+                total_tokens=prompt_tokens + self.completion_tokens,
+            ),
+        )
+
+    async def chat_stream(self, model: str, messages: list, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        for chunk in _split_tokens(self.response, self.completion_tokens):
+            await asyncio.sleep(self._token_delay())
+            yield chunk
+
+
+class FakeLlama:
+    """
+    Stands in for llama_cpp.Llama. It blocks the calling thread like the real
+    model does.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        tokens_per_second: float = None,
+        completion_tokens: int = 20,
+        response: str = "fake response",
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.response = response
+        self.model_path = "fake-llama"
+        self.calls = 0
+
+    def _token_delay(self):
+        if not self.tokens_per_second:
+            return 0
+        return 1 / self.tokens_per_second
+
+    def tokenize(self, text: bytes, add_bos: bool = True):
+        return text.split()
+
+    def __call__(self, prompt: str, stream: bool = False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        if stream:
+            return self._stream()
+
+        time.sleep(self._token_delay() * self.completion_tokens)
+        return {
+            "choices": [{"text": self.response}],
+            "usage": {
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": self.completion_tokens,
+            },
+        }
+
+    def _stream(self):
+        for chunk in _split_tokens(self.response, self.completion_tokens):
+            time.sleep(self._token_delay())
+            yield {"choices": [{"text": chunk}]}
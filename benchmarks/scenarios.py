@@ -0,0 +1,298 @@
+import asyncio
+from datetime import timedelta
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from bonsoir import ChatGPTAgentModule, LlamaCppModule
+from bonsoir.message_store import MessageStore
+from bonsoir.metrics import Metrics
+from bonsoir.scheduler import Scheduler
+
+from .fakes import FakeItl, FakeLlama, FakeOpenAIBackend
+
+
+SYSTEM_PROMPT = "You are ${character}. Reply to the conversation."
+USER_PROMPT = "Messages:\n${history}\n\nReply as ${character}."
+TEMPLATE_VARS = {"character": "Benchmark Pony"}
+
+
+def chatgpt_module(itl=None, backend=None, **kwargs):
+    return ChatGPTAgentModule(
+        itl or FakeItl(),
+        "fake-model",
+        api_key="fake-key",
+        template_vars=TEMPLATE_VARS,
+        backend=backend or FakeOpenAIBackend(),
+        store=MessageStore(),
+        **kwargs
+    )
+
+
+def llamacpp_module(itl=None, llm=None, **kwargs):
+    return LlamaCppModule(
+        itl or FakeItl(),
+        llm or FakeLlama(),
+        template_vars=TEMPLATE_VARS,
+        store=MessageStore(),
+        **kwargs
+    )
+
+
+async def ingestion(messages: int = 10000, history: int = 100):
+    """Throughput of messages through add_upstream into the history."""
+    itl = FakeItl()
+    module = chatgpt_module(itl)
+    module.add_upstream("user-messages", history=history, name="Anonymous")
+
+    start = time.perf_counter()
+    for i in range(messages):
+        await itl.deliver("user-messages", f"message number {i}")
+    elapsed = time.perf_counter() - start
+
+    return {
+        "messages": messages,
+        "seconds": elapsed,
+        "messages_per_second": messages / elapsed,
+    }
+
+
+async def history_rendering(lines: int, renders: int = 100):
+    """
+    Cost of rendering history with the given number of lines, both right after a
+    new message arrives and when nothing has changed.
+    """
+    module = chatgpt_module()
+    sources = 10
+    metadata = {"history": max(lines // sources, 1)}
+    for i in range(lines):
+        module.accept_message(f"user-{i % sources}", metadata, f"line {i}")
+
+    start = time.perf_counter()
+    for i in range(renders):
+        module.accept_message("user-0", metadata, f"new line {i}")
+        module.history
+    after_accept = (time.perf_counter() - start) / renders
+
+    start = time.perf_counter()
+    for i in range(renders):
+        module.history
+    cached = (time.perf_counter() - start) / renders
+
+    start = time.perf_counter()
+    for i in range(renders):
+        module.timeskip(timedelta(seconds=0))
+        module.history
+    full = (time.perf_counter() - start) / renders
+
+    return {
+        "lines": len(module._timeline),
+        "seconds_after_accept": after_accept,
+        "seconds_cached": cached,
+        "seconds_full_render": full,
+    }
+
+
+async def scheduler_overhead(downstreams: int = 1000, idle_seconds: float = 1.0):
+    """
+    CPU used by interval scheduling: arming timers for many downstreams, idling
+    with none due, rescheduling all of them, and firing short intervals.
+    """
+    backend = FakeOpenAIBackend()
+    metrics = Metrics()
+    module = chatgpt_module(backend=backend, metrics=metrics)
+    for i in range(downstreams):
+        module.add_downstream(
+            f"downstream-{i}", system_prompt=SYSTEM_PROMPT, user_prompt=USER_PROMPT
+        )
+
+    start = time.perf_counter()
+    for i in range(downstreams):
+        await module.set_generate_interval(f"downstream-{i}", timedelta(hours=1))
+    arm_seconds = time.perf_counter() - start
+
+    cpu_start = time.process_time()
+    await asyncio.sleep(idle_seconds)
+    idle_cpu = time.process_time() - cpu_start
+
+    start = time.perf_counter()
+    for i in range(downstreams):
+        module.delayed_maybe_respond(f"downstream-{i}", timedelta(minutes=30))
+    reschedule_seconds = time.perf_counter() - start
+
+    # A second module whose intervals are short enough to fire
+    module = chatgpt_module(backend=backend, metrics=metrics)
+    for i in range(downstreams):
+        module.add_downstream(
+            f"downstream-{i}", system_prompt=SYSTEM_PROMPT, user_prompt=USER_PROMPT
+        )
+        await module.set_generate_interval(
+            f"downstream-{i}", timedelta(milliseconds=100)
+        )
+    await asyncio.sleep(idle_seconds)
+
+    lag = metrics.histograms.get(("bonsoir_scheduler_lag_seconds", ()))
+    return {
+        "downstreams": downstreams,
+        "arm_seconds": arm_seconds,
+        "idle_cpu_seconds": idle_cpu,
+        "reschedule_seconds": reschedule_seconds,
+        "generations": backend.calls,
+        "generations_per_second": backend.calls / idle_seconds,
+        "mean_scheduler_lag_seconds": lag[-1] / sum(lag[:-1]) if lag else None,
+        "pending_timers": len(Scheduler.for_loop()),
+    }
+
+
+async def burst_reactions(burst: int = 20, latency: float = 0.05, **policy):
+    """A burst of upstream messages, each triggering a reaction."""
+    itl = FakeItl()
+    backend = FakeOpenAIBackend(latency=latency)
+    module = chatgpt_module(itl, backend=backend)
+    module.add_upstream("user-messages", history=burst, name="Anonymous")
+    module.add_downstream(
+        "replies", system_prompt=SYSTEM_PROMPT, user_prompt=USER_PROMPT
+    )
+    module.add_reaction("user-messages", "replies", **policy)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[itl.deliver("user-messages", f"message {i}") for i in range(burst)]
+    )
+    while module._tasks or module._debounce_timers:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "burst": burst,
+        "policy": {key: str(value) for key, value in policy.items()},
+        "generations": backend.calls,
+        "responses_sent": itl.sent["replies"],
+        "seconds": elapsed,
+    }
+
+
+async def grouped_reactions(
+    downstreams: int = 3, messages: int = 10, grouped: bool = False
+):
+    """
+    Several downstreams reacting to the same upstream, either each with its own
+    generation or as one downstream group.
+    """
+    itl = FakeItl()
+    names = [f"part-{i}" for i in range(downstreams)]
+    response = json.dumps({name: "fake response" for name in names})
+    backend = FakeOpenAIBackend(latency=0.01, response=response)
+    module = chatgpt_module(itl, backend=backend)
+    module.add_upstream("user-messages", history=messages, name="Anonymous")
+    for name in names:
+        module.add_downstream(
+            name, system_prompt=SYSTEM_PROMPT, user_prompt=USER_PROMPT
+        )
+    if grouped:
+        module.add_downstream_group(
+            "parts", names, system_prompt=SYSTEM_PROMPT, user_prompt=USER_PROMPT
+        )
+        module.add_reaction("user-messages", "parts")
+    else:
+        for name in names:
+            module.add_reaction("user-messages", name)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        await itl.deliver("user-messages", f"message {i}")
+    elapsed = time.perf_counter() - start
+
+    return {
+        "downstreams": downstreams,
+        "grouped": grouped,
+        "generations": backend.calls,
+        "responses_sent": sum(itl.sent[name] for name in names),
+        "seconds": elapsed,
+    }
+
+
+async def llamacpp_generation(modules: int = 4, requests: int = 10):
+    """Throughput of several modules sharing one llama.cpp model."""
+    llm = FakeLlama(latency=0.001)
+    instances = [llamacpp_module(llm=llm) for _ in range(modules)]
+    for module in instances:
+        module.accept_message("user", {"history": 10}, "hello")
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            module.generate_response("${history}")
+            for module in instances
+            for _ in range(requests)
+        ]
+    )
+    elapsed = time.perf_counter() - start
+
+    return {
+        "modules": modules,
+        "generations": llm.calls,
+        "seconds": elapsed,
+        "generations_per_second": llm.calls / elapsed,
+    }
+
+
+# Dependencies that importing bonsoir shouldn't load on its own
+HEAVY_MODULES = ("openai", "llama_cpp", "tiktoken", "httpx")
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import bonsoir
+for name in sys.argv[1:]:
+    getattr(bonsoir, name)
+elapsed = time.perf_counter() - start
+heavy = sorted(m for m in %r if m in sys.modules)
+print(json.dumps({"seconds": elapsed, "loaded": heavy}))
+""" % (HEAVY_MODULES,)
+
+
+async def import_time(attributes=(), runs: int = 5):
+    """
+    Cold start: the time to import bonsoir and the given attributes in a fresh
+    interpreter, and which heavy dependencies that loads.
+    """
+    samples = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT, *attributes],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output)
+        samples.append(result["seconds"])
+        loaded = result["loaded"]
+
+    return {
+        "runs": runs,
+        "median_seconds": statistics.median(samples),
+        "min_seconds": min(samples),
+        "loaded": loaded,
+    }
+
+
+SCENARIOS = [
+    ("import_time", import_time, {}),
+    ("import_time", import_time, {"attributes": ("LlamaCppModule",)}),
+    ("import_time", import_time, {"attributes": ("ChatGPTAgentModule",)}),
+    ("ingestion", ingestion, {}),
+    ("history_rendering", history_rendering, {"lines": 10}),
+    ("history_rendering", history_rendering, {"lines": 100}),
+    ("history_rendering", history_rendering, {"lines": 10000, "renders": 10}),
+    ("scheduler_overhead", scheduler_overhead, {}),
+    ("burst_reactions", burst_reactions, {}),
+    ("burst_reactions", burst_reactions, {"single_flight": True}),
+    ("burst_reactions", burst_reactions, {"debounce": timedelta(milliseconds=10)}),
+    ("grouped_reactions", grouped_reactions, {}),
+    ("grouped_reactions", grouped_reactions, {"grouped": True}),
+    ("llamacpp_generation", llamacpp_generation, {}),
+]
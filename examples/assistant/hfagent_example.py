@@ -1,10 +1,9 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import os
-import random
-import yaml
 
 from transformers.tools import OpenAiAgent, Tool
+from bonsoir import AgentPoolModule
 from itllib import Itl
 
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.yaml")
@@ -12,14 +11,6 @@ SECRETS_PATH = "./secrets"
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", None)
 
 
-itl = Itl()
-itl.apply_config(CONFIG_PATH, SECRETS_PATH)
-itl.start_thread()
-
-executor = ThreadPoolExecutor(max_workers=1)
-agent = OpenAiAgent(model="gpt-4-0613", api_key=OPENAI_API_KEY)
-agent.toolbox.clear()
-
 class Greeter(Tool):
     def __init__(self):
         super().__init__()
@@ -33,22 +24,47 @@ class Greeter(Tool):
     def __call__(self, username: str):
         return f'Hello, {username}!'
 
-agent.toolbox['greeter'] = Greeter()
 
-loop = asyncio.get_event_loop()
+# Tools are loaded once and shared by every session's agent
+TOOLBOX = {'greeter': Greeter()}
+
+
+def create_agent():
+    return OpenAiAgent(model="gpt-4-0613", api_key=OPENAI_API_KEY)
+
+
+async def main():
+    itl = Itl()
+    itl.apply_config(CONFIG_PATH, SECRETS_PATH)
+
+    # Requests are {"session": id, "request": text}, or plain text for the
+    # shared default session. Responses to a session are sent back as
+    # {"session": id, "response": response}.
+    module = AgentPoolModule(
+        itl,
+        create_agent,
+        toolbox=TOOLBOX,
+        max_sessions=32,
+        max_concurrency=4,
+        idle_timeout=timedelta(minutes=30),
+    )
 
-@itl.ondata("one-off-requests")
-async def handle_one_off_request(request):
-    response = await loop.run_in_executor(executor, agent.run, request)
-    await itl.stream_send("responses", response)
+    module.add_downstream("responses")
+    module.add_upstream("one-off-requests", mode="run", downstream="responses")
+    module.add_upstream("chat-requests", mode="chat", downstream="responses")
+    module.add_upstream("reset-chat", mode="reset")
 
+    itl.start_thread()
 
-@itl.ondata("chat-requests")
-async def handle_chat_request(request):
-    response = await loop.run_in_executor(executor, agent.chat, request)
-    await itl.stream_send("responses", response)
+    try:
+        while True:
+            await asyncio.sleep(10)
+    except asyncio.exceptions.CancelledError:
+        pass
+    finally:
+        module.close()
+        itl.stop_itl()
 
 
-@itl.ondata("reset-chat")
-async def handle_reset_chat(*args, **kwargs):
-    agent.prepare_for_new_chat()
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,5 @@
 import asyncio
 from datetime import timedelta
-import json
 import os
 import random
 import yaml
@@ -42,31 +41,29 @@ Decision: Based on the context and timing, decide whether to immediately respond
 """
 
 
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "delay": {"type": "number", "minimum": 0},
+        "message": {"type": "string"},
+    },
+    "anyOf": [{"required": ["message"]}, {"required": ["delay"]}],
+}
+
+
 async def postprocessor(module: ChatGPTAgentModule, downstream, message):
-    try:
-        print("generated response:", message)
-        message = json.loads(message)
-
-        if "message" in message:
-            valid_generation = True
-            result = message["message"]
-            module.append_history("Sunset Shimmer", result)
-        elif "delay" in message:
-            valid_generation = True
-            result = None
-
-            delay = timedelta(seconds=int(message["delay"]))
-            module.delayed_maybe_respond(downstream, delay)
-            print("retrying after delay:", delay)
-
-        if valid_generation:
-            return result
-    except Exception as e:
-        print("exception:", e)
-        raise
-
-    print("invalid generation (trying again):", message)
-    await module.maybe_respond(downstream)
+    # The module has already parsed and validated the response against
+    # RESPONSE_SCHEMA, retrying invalid generations a bounded number of times.
+    print("generated response:", message)
+
+    if "message" in message:
+        result = message["message"]
+        module.append_history("Sunset Shimmer", result)
+        return result
+
+    delay = timedelta(seconds=int(message["delay"]))
+    module.delayed_maybe_respond(downstream, delay)
+    print("retrying after delay:", delay)
     return None
 
 
@@ -79,6 +76,8 @@ async def main():
         "gpt-4-0613",
         template_vars=CHARACTER_DEFINITION,
         postprocessor=postprocessor,
+        # This model predates response_format, so the schema is only validated
+        response_format=None,
     )
 
     module.add_upstream("user-messages", history=10, name="Anonymous")
@@ -86,6 +85,7 @@ async def main():
         "sunset-shimmer",
         system_prompt=SYSTEM_PROMPT,
         user_prompt=USER_PROMPT,
+        schema=RESPONSE_SCHEMA,
     )
     module.add_reaction("user-messages", "sunset-shimmer")
     await module.set_generate_interval("sunset-shimmer", timedelta(seconds=60))
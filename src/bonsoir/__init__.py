@@ -1,4 +1,28 @@
-from .agentbase_module import AgentBaseModule
-from .chatgptagent_module import ChatGPTAgentModule
-from .chatagentbase_module import ChatAgentBaseModule
-from .llamacpp_module import LlamaCppModule
+import importlib
+
+# Modules are imported on first use, so importing bonsoir doesn't load every
+# backend and its dependencies.
+_LAZY_ATTRIBUTES = {
+    "AgentBaseModule": ".agentbase_module",
+    "AgentPoolModule": ".agentpool_module",
+    "ChatGPTAgentModule": ".chatgptagent_module",
+    "ChatAgentBaseModule": ".chatagentbase_module",
+    "LlamaCppModule": ".llamacpp_module",
+    "RouterModule": ".router_module",
+    "configure_default_store": ".message_store",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
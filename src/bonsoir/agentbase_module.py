@@ -1,9 +1,31 @@
 import asyncio
 from collections import defaultdict
+import contextvars
 from datetime import datetime, timedelta
+import logging
+import time
+import uuid
 
 from itllib import Itl
 
+from .clock import get_clock
+from .ingestion import IngestionQueue
+from .metrics import NullMetrics, null_metrics
+from .scheduler import Scheduler, TimerHandle
+from .structured import (
+    JSONStreamParser,
+    StructuredOutputError,
+    is_container_schema,
+    parse_structured,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# The downstream that the current task is generating a response for
+current_downstream = contextvars.ContextVar("current_downstream", default=None)
+
 
 async def nop_postprocessor(module, downstream, message):
     return message
@@ -13,6 +35,10 @@ async def nop_preprocessor(module, upstream, message):
     return message
 
 
+async def nop_stream_postprocessor(module, downstream, partial, chunk):
+    return chunk
+
+
 class AgentBaseModule:
     """
     This class is for cases where incoming messages can be decoupled from
@@ -33,135 +59,592 @@ class AgentBaseModule:
         itl: Itl,
         preprocessor=nop_preprocessor,
         postprocessor=nop_postprocessor,
+        scheduler: Scheduler = None,
+        stream_postprocessor=nop_stream_postprocessor,
+        metrics: NullMetrics = None,
+        clock=None,
     ):
         self.itl = itl
         self.preprocessor = preprocessor
         self.postprocessor = postprocessor
+        self.stream_postprocessor = stream_postprocessor
+        self._scheduler = scheduler
+        self.metrics = metrics if metrics is not None else null_metrics
+        # Defaults to the running event loop's clock, for simulations
+        self.clock = clock if clock is not None else get_clock()
 
         self.source_metadata = defaultdict(dict)  # type: dict[str, int]
         self.dest_metadata = defaultdict(dict)  # type: dict[str, int]
+        self.dest_options = defaultdict(dict)  # type: dict[str, dict]
+        # The member downstreams of each downstream group
+        self.dest_groups = {}  # type: dict[str, list[str]]
+        self.ingestion_queues = {}  # type: dict[str, IngestionQueue]
         self._last_attempted_response = defaultdict(
-            datetime.now
+            self.clock.now
         )  # type: dict[str, datetime]
-        self._pending_generations = defaultdict(int)  # type: dict[str, int]
+        # In-flight generations per downstream. A task appears once for each
+        # maybe_respond call it is running.
+        self._pending_generations = defaultdict(list)  # type: dict[str, list[asyncio.Task]]
+        self._generation_tasks = defaultdict(set)  # type: dict[str, set[asyncio.Task]]
+        self._stale_generations = set()  # type: set[str]
+        self._debounce_timers = {}  # type: dict[str, TimerHandle]
         self._default_interval_response = defaultdict(
             lambda: None
         )  # type: dict[str, timedelta]
         self._current_interval_response = defaultdict(lambda: None)
-        self._active_cycles = defaultdict(int)
-
-    def add_upstream(self, upstream: str, **kwargs):
+        self._generation_timers = {}  # type: dict[str, TimerHandle]
+        self._tasks = set()
+
+        # Incremented whenever a message from an upstream is accepted
+        self.input_version = 0
+        # The input version each downstream last generated a response for
+        self._attempted_version = {}  # type: dict[str, int]
+        # Downstreams whose interval has been stretched for lack of input
+        self._idle_downstreams = set()  # type: set[str]
+        self.periodic_fired = defaultdict(int)  # type: dict[str, int]
+        self.periodic_skipped = defaultdict(int)  # type: dict[str, int]
+
+    @property
+    def scheduler(self) -> Scheduler:
+        if self._scheduler is None:
+            self._scheduler = Scheduler.for_loop()
+            if not self._scheduler.metrics.enabled:
+                self._scheduler.metrics = self.metrics
+        return self._scheduler
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def add_upstream(
+        self,
+        upstream: str,
+        queue_size: int = None,
+        workers: int = 1,
+        overflow: str = "block",
+        **kwargs,
+    ):
+        """
+        Add an upstream. The kwargs are passed to accept_message as metadata.
+
+        By default, messages are preprocessed and accepted as itllib delivers them.
+        If queue_size is set, messages are put on a bounded IngestionQueue instead,
+        and preprocessed by the given number of worker tasks. Messages are still
+        accepted in the order they arrived. overflow decides what happens when the
+        queue is full: "block", "drop-oldest" or "drop-newest". Reactions to a
+        queued upstream run once the message has been accepted, so add the
+        upstream before its reactions.
+        """
         if upstream in self.source_metadata:
             raise ValueError(f"Upstream {upstream} already exists")
         self.source_metadata[upstream] = kwargs
 
+        if queue_size != None:
+            queue = IngestionQueue(self, upstream, queue_size, workers, overflow)
+            self.ingestion_queues[upstream] = queue
+
+            @self.itl.ondata(upstream)
+            async def enqueue_message(data):
+                self.metrics.increment(
+                    "bonsoir_messages_received_total", upstream=upstream
+                )
+                await queue.put(data)
+
+            return
+
         @self.itl.ondata(upstream)
         async def receive_message(data):
-            data = await self.preprocessor(self, upstream, data)
+            self.metrics.increment("bonsoir_messages_received_total", upstream=upstream)
+            with self.metrics.span("bonsoir_preprocess", upstream=upstream):
+                data = await self.preprocessor(self, upstream, data)
             if data != None:
                 metadata = self.source_metadata[upstream]
-                self.accept_message(upstream, metadata, data)
-
-    def add_downstream(self, downstream: str, **kwargs):
+                with self.metrics.span("bonsoir_accept", upstream=upstream):
+                    self.accept_message(upstream, metadata, data)
+                self._input_changed()
+
+    def _input_changed(self):
+        """Called after a message from an upstream is accepted."""
+        self.input_version += 1
+        # Idle downstreams go back to their normal interval
+        for downstream in list(self._idle_downstreams):
+            self._idle_downstreams.discard(downstream)
+            self._current_interval_response[
+                downstream
+            ] = self._default_interval_response.get(downstream)
+            self._schedule_generation(downstream)
+
+    def add_downstream(
+        self,
+        downstream: str,
+        stream=False,
+        schema: dict = None,
+        max_retries: int = 2,
+        retry_backoff: timedelta = timedelta(seconds=1),
+        **kwargs,
+    ):
+        """
+        Add a downstream. The kwargs are passed to generate_response.
+
+        If stream is True, the response is sent in chunks as it's generated. Each
+        chunk is passed through stream_postprocessor and sent as
+        {"stream": id, "delta": chunk}. Once generation finishes, the full response
+        goes through postprocessor as usual and is sent as
+        {"stream": id, "done": True, "message": data}.
+
+        If schema is set, responses must be JSON matching it. Backends that can
+        constrain their output to the schema do so, and the postprocessor gets the
+        parsed value. Invalid responses are repaired if possible, otherwise
+        regenerated up to max_retries times, waiting retry_backoff before the first
+        retry and twice as long before each one after. A retried stream gets a new
+        id, and the failed stream is never marked done.
+        """
         if downstream in self.dest_metadata:
             raise ValueError(f"Downstream {downstream} already exists")
         self.dest_metadata[downstream] = kwargs
-
-    def add_reaction(self, upstream, downstream):
+        self.dest_options[downstream] = {
+            "stream": stream,
+            "schema": schema,
+            "max_retries": max_retries,
+            "retry_backoff": retry_backoff,
+        }
+
+    def add_downstream_group(
+        self,
+        group: str,
+        downstreams: list,
+        max_retries: int = 2,
+        retry_backoff: timedelta = timedelta(seconds=1),
+        **kwargs,
+    ):
+        """
+        Generate the responses for several downstreams with a single call. The group
+        is added like a downstream, and the kwargs are passed to generate_response,
+        so reactions and intervals can be set on it. Its prompt should ask for a
+        JSON object with one key per downstream.
+
+        Each part is validated against its downstream's schema, or must be a
+        string if it has none. The parts are then passed through postprocessor and
+        sent on their own downstreams, as if each had been generated separately.
+        Nothing is sent on the group itself. Use "description" in the downstreams'
+        schemas to tell the model what each part is for.
+        """
+        for downstream in downstreams:
+            if downstream not in self.dest_metadata:
+                raise ValueError(
+                    f"Downstream {downstream} does not exist. Make sure to call add_downstream first."
+                )
+            if downstream in self.dest_groups:
+                raise ValueError("Downstream groups can't contain other groups")
+            if self.dest_options[downstream].get("stream"):
+                raise ValueError(
+                    f"Downstream {downstream} is streamed, so it can't be in a group"
+                )
+        if kwargs.get("stream"):
+            raise ValueError("Downstream groups can't be streamed")
+
+        properties = {}
+        for downstream in downstreams:
+            schema = self.dest_options[downstream].get("schema")
+            properties[downstream] = schema if schema != None else {"type": "string"}
+        schema = {
+            "type": "object",
+            "properties": properties,
+            "required": list(downstreams),
+            "additionalProperties": False,
+        }
+
+        self.add_downstream(
+            group,
+            schema=schema,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            **kwargs,
+        )
+        self.dest_groups[group] = list(downstreams)
+
+    def add_reaction(
+        self,
+        upstream,
+        downstream,
+        single_flight=False,
+        trailing=True,
+        cancel_stale=False,
+        debounce: timedelta = None,
+    ):
+        """
+        Generate a response on downstream whenever a message arrives on upstream.
+
+        By default, every message starts its own generation. The other options
+        coalesce bursts of messages:
+        - single_flight: Don't start a generation while one is already in flight
+          for this downstream.
+        - trailing: With single_flight, generate once more after the in-flight
+          generation finishes if messages arrived in the meantime.
+        - cancel_stale: With single_flight, cancel the in-flight generation and
+          start a new one instead of waiting for it.
+        - debounce: Wait until no message has arrived for this long before
+          generating.
+        """
         if downstream not in self.dest_metadata:
             raise ValueError(
                 f"Downstream {downstream} does not exist. Make sure to call add_downstream first."
             )
 
-        @self.itl.ondata(upstream)
+        if not single_flight and debounce == None:
+
+            @self._on_upstream(upstream)
+            async def receive_message(*unused_args, **unused_kwargs):
+                await self.maybe_respond(downstream)
+
+            return
+
+        def react():
+            self._debounce_timers.pop(downstream, None)
+            if single_flight and self.generation_pending(downstream, queued=True):
+                if cancel_stale:
+                    for task in self._generation_tasks[downstream]:
+                        task.cancel()
+                elif trailing:
+                    self._stale_generations.add(downstream)
+                    self.metrics.set_gauge(
+                        "bonsoir_generations_pending", 1, downstream=downstream
+                    )
+                    return
+                else:
+                    return
+            self._spawn_generation(downstream)
+
+        @self._on_upstream(upstream)
         async def receive_message(*unused_args, **unused_kwargs):
-            await self.maybe_respond(downstream)
+            if debounce == None:
+                react()
+                return
+
+            timer = self._debounce_timers.pop(downstream, None)
+            if timer != None:
+                timer.cancel()
+            self._debounce_timers[downstream] = self.scheduler.call_later(
+                debounce.total_seconds(), react
+            )
+
+    def _on_upstream(self, upstream: str):
+        """
+        Register a handler for messages on upstream. For queued upstreams, the
+        handler runs after the message is accepted.
+        """
+        queue = self.ingestion_queues.get(upstream)
+        if queue is None:
+            return self.itl.ondata(upstream)
+
+        def decorator(handler):
+            queue.on_accept.append(lambda data: self._spawn(handler(data)))
+            return handler
+
+        return decorator
+
+    def generation_pending(self, downstream: str, queued=False) -> bool:
+        """
+        Check whether a generation is running for downstream. With queued, also
+        count generations that have been started but haven't begun running.
+        """
+        if self._pending_generations[downstream]:
+            return True
+        if queued:
+            current = asyncio.current_task()
+            return any(task is not current for task in self._generation_tasks[downstream])
+        return False
+
+    def _spawn_generation(self, downstream: str):
+        task = self._spawn(self.maybe_respond(downstream))
+        self._generation_tasks[downstream].add(task)
+        task.add_done_callback(self._generation_tasks[downstream].discard)
+        return task
 
     async def maybe_respond(self, downstream):
-        print("generating a response for", downstream)
+        logger.debug("generating a response for %s", downstream)
         dest_metadata = self.dest_metadata[downstream]
 
-        self._last_attempted_response[downstream] = datetime.now()
-        self._pending_generations[downstream] += 1
+        self._last_attempted_response[downstream] = self.clock.now()
+        self._attempted_version[downstream] = self.input_version
+        self._idle_downstreams.discard(downstream)
+        self._stale_generations.discard(downstream)
+        generation = asyncio.current_task()
+        self._pending_generations[downstream].append(generation)
+
+        metrics = self.metrics
+        metrics.increment("bonsoir_generations_total", downstream=downstream)
+        metrics.set_gauge("bonsoir_generations_pending", 0, downstream=downstream)
+        metrics.add_gauge("bonsoir_generations_in_flight", 1, downstream=downstream)
         self._current_interval_response[
             downstream
         ] = self._default_interval_response.get(downstream)
-        response = await self.generate_response(**dest_metadata)
-
-        data = await self.postprocessor(self, downstream, response)
-        self._pending_generations[downstream] -= 1
+        self._schedule_generation(downstream)
+
+        context_token = current_downstream.set(downstream)
+        try:
+            with metrics.span("bonsoir_generate", downstream=downstream):
+                response, stream_id = await self._generate(downstream, dest_metadata)
+            if downstream in self.dest_groups:
+                sends = await self._postprocess_group(downstream, response)
+            else:
+                with metrics.span("bonsoir_postprocess", downstream=downstream):
+                    data = await self.postprocessor(self, downstream, response)
+                sends = [(downstream, data)]
+        finally:
+            current_downstream.reset(context_token)
+            metrics.add_gauge("bonsoir_generations_in_flight", -1, downstream=downstream)
+            self._pending_generations[downstream].remove(generation)
+            if (
+                downstream in self._stale_generations
+                and not self.generation_pending(downstream, queued=True)
+            ):
+                # New input arrived while this generation was in flight
+                self._spawn_generation(downstream)
+            else:
+                self._schedule_generation(downstream)
+
+        for downstream, data in sends:
+            with metrics.span("bonsoir_send", downstream=downstream):
+                if stream_id != None:
+                    await self.itl.stream_send(
+                        downstream, {"stream": stream_id, "done": True, "message": data}
+                    )
+                elif data != None:
+                    await self.itl.stream_send(downstream, data)
+
+    async def _postprocess_group(self, group: str, response: dict) -> list:
+        """Split a group's response and postprocess each downstream's part."""
+        sends = []
+        for downstream in self.dest_groups[group]:
+            context_token = current_downstream.set(downstream)
+            try:
+                with self.metrics.span("bonsoir_postprocess", downstream=downstream):
+                    data = await self.postprocessor(
+                        self, downstream, response[downstream]
+                    )
+            finally:
+                current_downstream.reset(context_token)
+            sends.append((downstream, data))
+        return sends
+
+    async def _generate(self, downstream, dest_metadata):
+        """
+        Generate a response for a downstream, validating it against the
+        downstream's schema if it has one. Returns the response and the stream id
+        it was sent on, if it was streamed.
+        """
+        options = self.dest_options[downstream]
+        schema = options.get("schema")
+        attempt = 0
+        while True:
+            stream_id = None
+            try:
+                if options.get("stream"):
+                    stream_id = uuid.uuid4().hex
+                    response = await self._stream_response(
+                        downstream, stream_id, dest_metadata
+                    )
+                else:
+                    response = await self.generate_response(**dest_metadata)
+                if schema == None:
+                    return response, stream_id
+                return parse_structured(response, schema), stream_id
+            except StructuredOutputError as e:
+                self.metrics.increment(
+                    "bonsoir_invalid_generations_total", downstream=downstream
+                )
+                if attempt >= options["max_retries"]:
+                    raise
+                backoff = options["retry_backoff"] * 2**attempt
+                attempt += 1
+                logger.warning("invalid generation (retrying in %s): %s", backoff, e)
+                await asyncio.sleep(backoff.total_seconds())
+
+    async def _stream_response(self, downstream, stream_id, dest_metadata):
+        parser = None
+        schema = self.dest_options[downstream].get("schema")
+        # Scalars can't be followed as they stream, so they're only parsed at the end
+        if schema != None and is_container_schema(schema):
+            parser = JSONStreamParser()
+
+        partial = ""
+        start = time.perf_counter()
+        chunks = self.generate_response_stream(**dest_metadata)
+        try:
+            async for chunk in chunks:
+                if not partial:
+                    self.metrics.observe(
+                        "bonsoir_time_to_first_token_seconds",
+                        time.perf_counter() - start,
+                        downstream=downstream,
+                    )
+                end = parser.feed(chunk) if parser != None else None
+                if end != None:
+                    chunk = chunk[:end]
+                partial += chunk
+                delta = await self.stream_postprocessor(
+                    self, downstream, partial, chunk
+                )
+                if delta:
+                    await self.itl.stream_send(
+                        downstream, {"stream": stream_id, "delta": delta}
+                    )
+                if end != None:
+                    # Don't wait for anything the model generates after the value
+                    break
+        finally:
+            await chunks.aclose()
+        return partial
+
+    def downstream_schema(self, downstream: str = None) -> dict:
+        """
+        The schema for a downstream's responses, if any. Defaults to the
+        downstream currently being generated for.
+        """
+        if downstream == None:
+            downstream = current_downstream.get()
+        if downstream == None:
+            return None
+        return self.dest_options[downstream].get("schema")
 
-        if data != None:
-            await self.itl.stream_send(downstream, data)
+    def _cacheable(self, response: str) -> bool:
+        """
+        Whether a response matches the current downstream's schema, if it has one.
+        Modules with a cache use this so invalid responses aren't cached, and
+        retries after an invalid response get a new generation.
+        """
+        schema = self.downstream_schema()
+        if schema == None:
+            return True
+        try:
+            parse_structured(response, schema)
+        except StructuredOutputError:
+            return False
+        return True
 
     async def add_periodic_response(
         self, seconds: float, downstream: str, *args, **kwargs
     ):
         async def response_task():
-            while True:
-                await asyncio.sleep(seconds)
+            try:
                 await self.maybe_respond(downstream)
+            finally:
+                self.scheduler.call_later(seconds, start_response_task)
+
+        def start_response_task():
+            self._spawn(response_task())
 
-        asyncio.create_task(response_task())
+        self.scheduler.call_later(seconds, start_response_task)
 
     def delayed_maybe_respond(self, downstream: str, interval: timedelta):
         self._current_interval_response[downstream] = interval
+        self._schedule_generation(downstream)
 
-    async def set_generate_interval(self, downstream: str, new_interval: timedelta):
+    async def set_generate_interval(
+        self,
+        downstream: str,
+        new_interval: timedelta,
+        skip_unchanged: bool = False,
+        idle_backoff: float = 2,
+        max_idle_interval: timedelta = None,
+    ):
         """
         Set the default interval between generations. If a message hasn't been sent
         in this interval, a new message will be generated. This can be overridden
         temporarily by calling delayed_maybe_respond.
 
+        If skip_unchanged is set, the interval only triggers a generation if a
+        message has arrived since the last one. Otherwise the interval is skipped,
+        and the next one is idle_backoff times longer, up to max_idle_interval,
+        until a message arrives. Leave it off if the passage of time alone should
+        lead to a response. The fired and skipped intervals are counted in
+        periodic_fired and periodic_skipped.
+
         This method returns immediately. It's async because it requires an event loop
-        for the periodic response task.
+        for the scheduler.
         """
 
         if downstream not in self.dest_metadata:
             raise ValueError(f"Downstream {downstream} does not exist")
 
+        options = self.dest_options[downstream]
+        options["skip_unchanged"] = skip_unchanged
+        options["idle_backoff"] = idle_backoff
+        options["max_idle_interval"] = max_idle_interval
+
         self._default_interval_response[downstream] = new_interval
-        if downstream not in self._current_interval_response:
+        if self._current_interval_response.get(downstream) == None:
             self._current_interval_response[downstream] = new_interval
 
-        # Indicate that other cycle tasks should stop. This can be replaced with a
-        # queue-based approach if we want to stop other cycles immediately.
-        self._active_cycles[downstream] += 1
-        current_cycle = self._active_cycles[downstream]
-
-        async def default_response_task():
-            while True:
-                if self._pending_generations[downstream] > 0:
-                    print("pending generation")
-                    await asyncio.sleep(1)
-                    continue
-
-                # Stop if a new cycle has started. This should come after all waits
-                # and before attempting a generation.
-                if self._active_cycles[downstream] != current_cycle:
-                    print("not my cycle")
-                    return
+        self._schedule_generation(downstream)
 
-                # Get the latest interval for this cycle
-                current_interval = self._current_interval_response[downstream]
-
-                # Check if enough time has passed
-                time_passed = datetime.now() - self._last_attempted_response[downstream]
-                if time_passed > current_interval:
-                    # If so, generate a new response
-                    await self.maybe_respond(downstream)
-                    # current interval might have changed, so get it again
-                    current_interval = self._current_interval_response[downstream]
-                    remaining_seconds = current_interval.total_seconds()
-                else:
-                    remaining_seconds = (current_interval - time_passed).total_seconds()
-
-                await asyncio.sleep(remaining_seconds)
-
-        asyncio.create_task(default_response_task())
+    def _schedule_generation(self, downstream: str):
+        """
+        (Re)arm the interval timer for a downstream. There is at most one timer per
+        downstream, and none while a generation is pending. maybe_respond calls this
+        again once the generation finishes.
+        """
+        timer = self._generation_timers.pop(downstream, None)
+        if timer != None:
+            timer.cancel()
+
+        if self._default_interval_response.get(downstream) == None:
+            return
+        if self.generation_pending(downstream):
+            return
+
+        current_interval = self._current_interval_response[downstream]
+        deadline = self._last_attempted_response[downstream] + current_interval
+        remaining_seconds = (deadline - self.clock.now()).total_seconds()
+        self._generation_timers[downstream] = self.scheduler.call_later(
+            remaining_seconds, self._generation_timer_fired, downstream
+        )
+
+    def _generation_timer_fired(self, downstream: str):
+        del self._generation_timers[downstream]
+        options = self.dest_options[downstream]
+        if (
+            options.get("skip_unchanged")
+            and self._attempted_version.get(downstream) == self.input_version
+        ):
+            self._skip_interval(downstream)
+            return
+
+        self.periodic_fired[downstream] += 1
+        self.metrics.increment(
+            "bonsoir_periodic_generations_total", downstream=downstream, outcome="fired"
+        )
+        self._spawn_generation(downstream)
+
+    def _skip_interval(self, downstream: str):
+        """Nothing has arrived since the last generation, so wait longer."""
+        self.periodic_skipped[downstream] += 1
+        self.metrics.increment(
+            "bonsoir_periodic_generations_total", downstream=downstream, outcome="skipped"
+        )
+
+        options = self.dest_options[downstream]
+        interval = self._current_interval_response[downstream] * options["idle_backoff"]
+        max_interval = options["max_idle_interval"]
+        if max_interval != None and interval > max_interval:
+            interval = max_interval
+        self._current_interval_response[downstream] = interval
+        self._idle_downstreams.add(downstream)
+        self._last_attempted_response[downstream] = self.clock.now()
+        self._schedule_generation(downstream)
 
     async def generate_response(self, **metadata):
         raise NotImplementedError()
 
+    async def generate_response_stream(self, **metadata):
+        """
+        Yield the response in chunks. Subclasses that can stream should override
+        this. By default, the whole response is yielded as a single chunk.
+        """
+        yield await self.generate_response(**metadata)
+
     def accept_message(self, source: str, metadata: dict, message: str):
         raise NotImplementedError()
@@ -0,0 +1,224 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from itllib import Itl
+
+from .agentbase_module import AgentBaseModule
+
+
+REQUEST_MODES = ("run", "chat", "reset")
+
+
+def default_session_key(message):
+    """
+    Split a request into its session and payload. Requests can be
+    {"session": id, "request": payload}, or a bare payload with no session.
+    """
+    if isinstance(message, dict):
+        return message.get("session"), message.get("request")
+    return None, message
+
+
+class _Session:
+    __slots__ = ("agent", "lock", "last_used")
+
+    def __init__(self, last_used):
+        self.agent = None
+        self.lock = asyncio.Lock()
+        self.last_used = last_used
+
+
+class AgentPoolModule(AgentBaseModule):
+    """
+    Serves requests to blocking tool-using agents, like transformers' OpenAiAgent,
+    with one agent per chat session. Agents are created with agent_factory() and
+    run on a thread pool, with at most max_concurrency requests running at once.
+
+    Each upstream is added with a mode:
+    - "chat": Continue the session's chat with agent.chat. Requests in the same
+      session run one at a time.
+    - "run": A one-off agent.run. Requests without a session use any free agent.
+    - "reset": Start a new chat in the session.
+    Responses are sent to the upstream's downstream, wrapped as
+    {"session": id, "response": response} if the request had a session. The
+    session_key function splits requests into their session and payload.
+
+    At most max_sessions sessions are kept, evicting the least recently used, and
+    sessions idle for idle_timeout are evicted. If a toolbox dict is given, every
+    agent's toolbox is replaced with its tools, so they're only loaded once.
+    """
+
+    def __init__(
+        self,
+        itl: Itl,
+        agent_factory,
+        *args,
+        toolbox: dict = None,
+        max_sessions: int = 64,
+        max_concurrency: int = 4,
+        idle_timeout: timedelta = timedelta(minutes=30),
+        session_key=default_session_key,
+        **kwargs
+    ):
+        super().__init__(itl, *args, **kwargs)
+        self.agent_factory = agent_factory
+        self.toolbox = toolbox
+        self.max_sessions = max_sessions
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+        self.session_key = session_key
+
+        self.sessions = OrderedDict()  # type: OrderedDict[object, _Session]
+        # Agents for one-off requests that don't belong to a session
+        self._free_agents = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="bonsoir-agent"
+        )
+        self._semaphore = None
+        self._sweep_timer = None
+
+    def add_upstream(
+        self, upstream: str, mode: str = "chat", downstream: str = None, **kwargs
+    ):
+        if mode not in REQUEST_MODES:
+            raise ValueError(f"Unknown mode {mode}, expected one of {REQUEST_MODES}")
+        if mode != "reset" and downstream not in self.dest_metadata:
+            raise ValueError(
+                f"Downstream {downstream} does not exist. Make sure to call add_downstream first."
+            )
+        super().add_upstream(upstream, mode=mode, downstream=downstream, **kwargs)
+
+    def accept_message(self, source: str, metadata: dict, message):
+        self._spawn(self._handle_request(metadata, message))
+
+    async def _run_in_executor(self, function, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, function, *args)
+
+    async def _create_agent(self):
+        agent = await self._run_in_executor(self.agent_factory)
+        if self.toolbox != None:
+            agent.toolbox.clear()
+            agent.toolbox.update(self.toolbox)
+        return agent
+
+    async def _handle_request(self, metadata: dict, message):
+        mode = metadata["mode"]
+        session_id, request = self.session_key(message)
+        if mode == "reset":
+            await self.reset_session(session_id)
+            return
+
+        downstream = metadata["downstream"]
+        try:
+            with self.metrics.span("bonsoir_agent_request", mode=mode):
+                if mode == "run" and session_id == None:
+                    response = await self._run_one_off(request)
+                else:
+                    response = await self._run_in_session(session_id, mode, request)
+        except Exception as e:
+            asyncio.get_running_loop().call_exception_handler(
+                {"message": "Exception in agent", "exception": e}
+            )
+            return
+
+        data = await self.postprocessor(self, downstream, response)
+        if data == None:
+            return
+        if session_id != None:
+            data = {"session": session_id, "response": data}
+        await self.itl.stream_send(downstream, data)
+
+    async def _run_one_off(self, request):
+        agent = self._free_agents.pop() if self._free_agents else None
+        if agent == None:
+            agent = await self._create_agent()
+        try:
+            return await self._run_in_executor(agent.run, request)
+        finally:
+            if len(self._free_agents) < self.max_concurrency:
+                self._free_agents.append(agent)
+
+    async def _run_in_session(self, session_id, mode: str, request):
+        session = self._session(session_id)
+        try:
+            async with session.lock:
+                session.last_used = self.clock.now()
+                if session.agent == None:
+                    session.agent = await self._create_agent()
+                method = session.agent.chat if mode == "chat" else session.agent.run
+                try:
+                    response = await self._run_in_executor(method, request)
+                finally:
+                    session.last_used = self.clock.now()
+        finally:
+            # Once unlocked, the session can be swept when it goes idle
+            self._schedule_sweep()
+        # Sessions that were busy when the pool overflowed can be evicted now
+        self._evict_overflow()
+        return response
+
+    def _session(self, session_id) -> _Session:
+        session = self.sessions.get(session_id)
+        if session == None:
+            session = _Session(self.clock.now())
+            self.sessions[session_id] = session
+            self._evict_overflow()
+        else:
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def _evict_overflow(self):
+        # Sessions with a request in progress, and the most recently used
+        # session, are never evicted
+        for session_id, session in list(self.sessions.items())[:-1]:
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if not session.lock.locked():
+                del self.sessions[session_id]
+        self.metrics.set_gauge("bonsoir_agent_sessions", len(self.sessions))
+
+    async def reset_session(self, session_id):
+        """Start a new chat in a session, once its current request finishes."""
+        session = self.sessions.get(session_id)
+        if session == None:
+            return
+        async with session.lock:
+            if session.agent != None:
+                session.agent.prepare_for_new_chat()
+
+    def _schedule_sweep(self):
+        if self._sweep_timer != None:
+            return
+        # Busy sessions aren't swept. They call this again when they finish.
+        idle = [
+            session.last_used
+            for session in self.sessions.values()
+            if not session.lock.locked()
+        ]
+        if not idle:
+            return
+        delay = (min(idle) + self.idle_timeout - self.clock.now()).total_seconds()
+        # After a sweep, every idle session left expires in the future
+        self._sweep_timer = self.scheduler.call_later(max(delay, 0), self._sweep)
+
+    def _sweep(self):
+        """Evict sessions that have been idle for idle_timeout."""
+        self._sweep_timer = None
+        cutoff = self.clock.now() - self.idle_timeout
+        for session_id, session in list(self.sessions.items()):
+            if session.last_used <= cutoff and not session.lock.locked():
+                del self.sessions[session_id]
+        self.metrics.set_gauge("bonsoir_agent_sessions", len(self.sessions))
+        self._schedule_sweep()
+
+    def close(self):
+        if self._sweep_timer != None:
+            self._sweep_timer.cancel()
+            self._sweep_timer = None
+        self._executor.shutdown(wait=False)
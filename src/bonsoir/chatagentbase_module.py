@@ -1,11 +1,41 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
-import heapq
+import asyncio
+import itertools
 import json
 
 from itllib import Itl
 
-from .agentbase_module import AgentBaseModule
+from .agentbase_module import AgentBaseModule, current_downstream
+from .history_log import (
+    INTERVALS,
+    MESSAGE,
+    SUMMARY,
+    HistoryLog,
+    encode_intervals,
+    encode_message,
+    encode_summary,
+)
+from .message_store import MessageRecord, MessageStore, SourceBuffer, default_store
+from .tokenizers import ApproximateTokenizer
+
+
+# Roughly the number of tokens in a rendered line's "[Sent X ago]" label
+LABEL_TOKENS = 8
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a chat conversation. Given the summary so far and
+the next lines of the conversation, write an updated summary. Keep who said what,
+anything that was decided or asked and not yet answered, and details that may come
+up again. Be concise, and reply with only the summary.
+"""
+
+
+def summary_request(summary: str, lines: list) -> str:
+    """The user message for a summarizer, given the summary so far and new lines."""
+    return "Summary so far:\n{}\n\nNew lines:\n{}".format(
+        summary or "(none)", "\n".join(lines)
+    )
 
 
 def human_readable_timedelta(td):
@@ -37,67 +67,396 @@ def human_readable_timedelta(td):
 
 
 class ChatAgentBaseModule(AgentBaseModule):
-    def __init__(self, itl: Itl, *args, **kwargs):
+    """
+    Keeps a history of the messages from its upstreams for rendering into prompts.
+    Messages are held in store, or by default in a store shared by the whole
+    process. Its total size can be capped with configure_default_store or the
+    BONSOIR_HISTORY_MAX_BYTES environment variable.
+
+    If a summarizer is given, whenever a source has more than summarize_threshold
+    messages, its oldest summarize_batch messages are folded into a running
+    summary in the background and dropped from the history. The summary is
+    available to prompts as ${summary}, so prompts stay about the same size over
+    long conversations. The summarizer is called as
+    summarizer(module, summary, lines) with the messages being folded, and returns
+    the new summary. See chat_summarizer and llama_summarizer. Each upstream's
+    history must then be larger than summarize_threshold, or its messages would be
+    dropped before there are enough of them to summarize.
+    """
+
+    def __init__(
+        self,
+        itl: Itl,
+        *args,
+        store: MessageStore = None,
+        tokenizer=None,
+        history_log: HistoryLog = None,
+        summarizer=None,
+        summarize_threshold: int = 50,
+        summarize_batch: int = 10,
+        **kwargs
+    ):
         super().__init__(itl, *args, **kwargs)
-        self.messages = defaultdict(list)
+        self._store = store if store is not None else default_store
+        self._owner_id = self._store.register(self)
+        self.tokenizer = tokenizer if tokenizer is not None else ApproximateTokenizer()
+        self._buffers = {}  # type: dict[int, SourceBuffer]
         self._history = None
-        self._last_timestamps = {}
+        self._history_expires = None
+        self._windowed_history = {}  # type: dict[int, tuple[str, float]]
         self._time_offset = timedelta(seconds=0)
-        self._names = {}
         self._name_references = defaultdict(object)
 
+        # The merged history timeline, ordered by (timestamp, seq). Records are
+        # inserted once when accepted and dropped in O(1) when evicted.
+        self._timeline = OrderedDict()  # type: OrderedDict[int, MessageRecord]
+
+        self.summarizer = summarizer
+        self.summarize_threshold = summarize_threshold
+        self.summarize_batch = summarize_batch
+        self.summary = ""
+        self._summary_task = None
+
+        # The latest capacity requested for each source, for snapshots
+        self._capacities = {}  # type: dict[int, int]
+        # The intervals last written to the history log, per downstream
+        self._logged_intervals = {}  # type: dict[str, tuple]
+        self.history_log = history_log
+        if history_log != None:
+            self._recover_history()
+
+    def add_upstream(self, upstream: str, history: int = 1, **kwargs):
+        """Add an upstream. The latest history messages from it are kept."""
+        if self.summarizer != None and history <= self.summarize_threshold:
+            raise ValueError(
+                f"Upstream {upstream} keeps {history} messages, but messages are only "
+                f"summarized once there are more than summarize_threshold "
+                f"({self.summarize_threshold}). Increase history or lower "
+                f"summarize_threshold."
+            )
+        super().add_upstream(upstream, history=history, **kwargs)
+
+    def add_downstream(self, downstream: str, history_tokens: int = None, **kwargs):
+        """
+        Add a downstream. If history_tokens is set, the history rendered for this
+        downstream is limited to that many tokens, filled with the newest messages
+        first across all sources.
+        """
+        super().add_downstream(downstream, **kwargs)
+        self.dest_options[downstream]["history_tokens"] = history_tokens
+
+        if downstream in self._logged_intervals:
+            # Resume the interval recovered from the history log
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._schedule_generation(downstream)
+
+    @property
+    def messages(self):
+        result = {}
+        for source_id, buffer in self._buffers.items():
+            source = self._store.source(source_id)
+            result[source] = [
+                (
+                    datetime.fromtimestamp(record.timestamp),
+                    source,
+                    record.payload.decode("utf-8"),
+                )
+                for record in buffer.records
+            ]
+        return result
+
     def accept_message(self, source: str, metadata: dict, message: str):
-        self._names[source] = metadata.get("name", source)
+        name = metadata.get("name", source)
+        timestamp = (self.clock.now() + self._time_offset).timestamp()
+        encoded_message = json.dumps(message).encode("utf-8")
+        capacity = metadata.get("history", 1)
+        record = self._store_message(
+            source, name, timestamp, encoded_message, capacity
+        )
+
+        if self.history_log != None:
+            self.history_log.append_message(
+                timestamp,
+                capacity,
+                record.tokens,
+                not isinstance(source, str),
+                source if isinstance(source, str) else name,
+                str(name),
+                encoded_message,
+            )
+            if self.history_log.due_for_snapshot:
+                self.history_log.write_snapshot(self._snapshot_entries())
+
+    def _store_message(
+        self,
+        source,
+        name,
+        timestamp: float,
+        encoded_message: bytes,
+        capacity: int,
+        tokens: int = None,
+    ) -> MessageRecord:
+        buffer = self._store.buffer(self._owner_id, source)
+        self._buffers[buffer.source_id] = buffer
+        self._capacities[buffer.source_id] = capacity
+
+        if buffer.name != name:
+            # Cached lines for this source show the old name
+            for record in buffer.records:
+                record.line = None
+            buffer.name = name
+
+        evicted = self._store.append(buffer, timestamp, encoded_message, capacity)
+
+        record = buffer.records[-1]
+        if tokens == None:
+            tokens = (
+                self.tokenizer.count(f"- [{name}]: {encoded_message.decode('utf-8')}")
+                + LABEL_TOKENS
+            )
+        record.tokens = tokens
+        self._insert_record(record)
+        for evicted_record in evicted:
+            del self._timeline[evicted_record.seq]
+
+        self._invalidate_history()
+        self._maybe_summarize()
+        return record
 
-        orig_timestamp = datetime.now() + self._time_offset
-        self._last_timestamps[source] = orig_timestamp
+    def _maybe_summarize(self):
+        if self.summarizer == None or self._summary_task != None:
+            return
+        for buffer in self._buffers.values():
+            if len(buffer.records) > self.summarize_threshold:
+                break
+        else:
+            return
 
-        encoded_message = json.dumps(message)
-        self.messages[source].append((orig_timestamp, source, encoded_message))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Recovering history before the event loop starts
+            return
+        self._summary_task = self._spawn(self._summarize(buffer))
 
-        if len(self.messages[source]) > metadata.get("history", 1):
-            self.messages[source].pop(0)
+    async def _summarize(self, buffer: SourceBuffer):
+        """Fold a source's oldest messages into the summary."""
+        records = list(itertools.islice(buffer.records, self.summarize_batch))
+        lines = [
+            f"- [{buffer.name}]: {record.payload.decode('utf-8')}" for record in records
+        ]
+        try:
+            with self.metrics.span("bonsoir_summarize"):
+                summary = await self.summarizer(self, self.summary, lines)
+        except Exception as e:
+            asyncio.get_running_loop().call_exception_handler(
+                {"message": "Exception in summarizer", "exception": e}
+            )
+            return
+        finally:
+            self._summary_task = None
+
+        source, count = None, 0
+        if self._buffers.get(buffer.source_id) is buffer:
+            # Some of the folded messages may have been evicted in the meantime
+            source = self._store.source(buffer.source_id)
+            count = sum(1 for record in buffer.records if record.seq <= records[-1].seq)
+        self._fold(source, count, summary)
+
+        if self.history_log != None:
+            is_reference = source != None and not isinstance(source, str)
+            self.history_log.append_summary(
+                count,
+                is_reference,
+                str(buffer.name) if is_reference else (source or ""),
+                summary,
+            )
+        self._maybe_summarize()
+
+    def _fold(self, source, count: int, summary: str):
+        """Replace the oldest count messages from source with the new summary."""
+        self.summary = summary
+        if count > 0:
+            buffer = self._store.buffer(self._owner_id, source)
+            records = list(itertools.islice(buffer.records, count))
+            for record in self._store.drop_through(buffer, records[-1].seq):
+                self._timeline.pop(record.seq, None)
+        self._invalidate_history()
+
+    def _recover_history(self):
+        for entry in self.history_log.recover():
+            if entry[0] == MESSAGE:
+                _, timestamp, capacity, tokens, is_reference, source, name, payload = entry
+                if is_reference:
+                    source = self._name_references[source]
+                self._store_message(source, name, timestamp, payload, capacity, tokens)
+            elif entry[0] == SUMMARY:
+                _, count, is_reference, source, summary = entry
+                if is_reference:
+                    source = self._name_references[source]
+                self._fold(source, count, summary)
+            elif entry[0] == INTERVALS:
+                _, downstream, default, current, last_attempt = entry
+                self._logged_intervals[downstream] = (default, current, last_attempt)
+                if default != None:
+                    self._default_interval_response[downstream] = timedelta(
+                        seconds=default
+                    )
+                if current != None:
+                    self._current_interval_response[downstream] = timedelta(
+                        seconds=current
+                    )
+                if last_attempt != None:
+                    self._last_attempted_response[
+                        downstream
+                    ] = datetime.fromtimestamp(last_attempt)
 
+    def _snapshot_entries(self):
+        """Encode the current history, summary and intervals as history log entries."""
+        if self.summary:
+            yield encode_summary(0, False, "", self.summary)
+        for record in self._timeline.values():
+            buffer = self._buffers[record.source_id]
+            source = self._store.source(record.source_id)
+            is_reference = not isinstance(source, str)
+            yield encode_message(
+                record.timestamp,
+                max(self._capacities[record.source_id], len(buffer.records)),
+                record.tokens,
+                is_reference,
+                buffer.name if is_reference else source,
+                str(buffer.name),
+                record.payload,
+            )
+        for downstream, intervals in self._logged_intervals.items():
+            yield encode_intervals(downstream, *intervals)
+
+    def _schedule_generation(self, downstream: str):
+        if self.history_log != None:
+            self._log_intervals(downstream)
+        super()._schedule_generation(downstream)
+
+    def _log_intervals(self, downstream: str):
+        default = self._default_interval_response.get(downstream)
+        current = self._current_interval_response.get(downstream)
+        last_attempt = self._last_attempted_response.get(downstream)
+        intervals = (
+            default.total_seconds() if default != None else None,
+            current.total_seconds() if current != None else None,
+            last_attempt.timestamp() if last_attempt != None else None,
+        )
+        if self._logged_intervals.get(downstream) != intervals:
+            self._logged_intervals[downstream] = intervals
+            self.history_log.append_intervals(downstream, *intervals)
+
+    def _invalidate_history(self):
         self._history = None
+        self._windowed_history.clear()
+
+    def _insert_record(self, record: MessageRecord):
+        if self._timeline:
+            previous = self._timeline[next(reversed(self._timeline))]
+            out_of_order = record.timestamp < previous.timestamp
+        else:
+            out_of_order = False
+
+        self._timeline[record.seq] = record
+        if out_of_order:
+            # Timestamps only go backwards if the system clock does, so this is rare
+            ordered = sorted(self._timeline.values(), key=lambda r: (r.timestamp, r.seq))
+            self._timeline = OrderedDict((r.seq, r) for r in ordered)
+
+    def _forget_source(self, source, buffer: SourceBuffer):
+        """Called by the message store when it evicts one of our sources."""
+        if self._buffers.get(buffer.source_id) is not buffer:
+            return
+        del self._buffers[buffer.source_id]
+        self._capacities.pop(buffer.source_id, None)
+        for record in buffer.records:
+            self._timeline.pop(record.seq, None)
+        self._invalidate_history()
 
     def append_history(self, name, message):
         reference = self._name_references[name]
         self.accept_message(reference, {"name": name}, message)
 
+    def _render_record(self, record: MessageRecord, now: float):
+        age = timedelta(seconds=now - record.timestamp) + self._time_offset
+        relative_time = human_readable_timedelta(age)
+        name = self._buffers[record.source_id].name
+        message = record.payload.decode("utf-8")
+        # Note: putting the time info after the message seems to work much better than before
+        record.line = f"- [{name}]: {message} [Sent {relative_time} ago]"
+        # The label has a resolution of one second
+        record.expires = now + (1000000 - age.microseconds) / 1000000
+
+    def _render(self, records, now: float):
+        result = []
+        expires = float("inf")
+        for record in records:
+            if record.line is None or now >= record.expires:
+                self._render_record(record, now)
+            expires = min(expires, record.expires)
+            result.append(record.line)
+
+        return "\n".join(result), expires
+
     @property
     def history(self):
-        if self._history != None:
+        now = self.clock.now().timestamp()
+        if self._history != None and now < self._history_expires:
             return self._history
 
-        used_messages = defaultdict(lambda: 0)
-        candidates = []
-        result = []
-
-        # Initialize candidates with the oldest message from each source
-        for source in self.messages:
-            source_history = self.messages[source]
-            if source_history:
-                candidates.append(source_history[0])
-                used_messages[source] = 1
-        heapq.heapify(candidates)
-
-        # Keep adding the oldest message to the history
-        while candidates:
-            timestamp, source, message = heapq.heappop(candidates)
-            relative_time = human_readable_timedelta(
-                datetime.now() - timestamp + self._time_offset
+        with self.metrics.span("bonsoir_history_render"):
+            self._history, self._history_expires = self._render(
+                self._timeline.values(), now
             )
-            name = self._names.get(source, source)
-            # Note: putting the time info after the message seems to work much better than before
-            chat_line = f"- [{name}]: {message} [Sent {relative_time} ago]"
+        return self._history
 
-            result.append(chat_line)
-            if used_messages[source] < len(self.messages[source]):
-                heapq.heappush(candidates, self.messages[source][used_messages[source]])
-                used_messages[source] += 1
+    def render_history(self, max_tokens: int = None) -> str:
+        """
+        Render the history, keeping only the newest lines that fit in max_tokens.
+        Token counts are computed once when each message is accepted, so this only
+        looks at the lines that end up included.
+        """
+        if max_tokens == None:
+            return self.history
 
-        self._history = "\n".join(result)
-        return self._history
+        now = self.clock.now().timestamp()
+        cached = self._windowed_history.get(max_tokens)
+        if cached != None and now < cached[1]:
+            return cached[0]
+
+        included = []
+        remaining = max_tokens
+        for record in reversed(self._timeline.values()):
+            remaining -= record.tokens
+            if remaining < 0:
+                break
+            included.append(record)
+        included.reverse()
+
+        with self.metrics.span("bonsoir_history_render"):
+            rendered = self._render(included, now)
+        self._windowed_history[max_tokens] = rendered
+        return rendered[0]
+
+    def downstream_history(self, downstream: str = None) -> str:
+        """
+        Render the history for a downstream, applying its history_tokens limit.
+        Defaults to the downstream currently being generated for.
+        """
+        if downstream == None:
+            downstream = current_downstream.get()
+        if downstream == None:
+            return self.history
+        return self.render_history(self.dest_options[downstream].get("history_tokens"))
 
     def timeskip(self, interval: timedelta):
         self._time_offset += interval
+        self._invalidate_history()
+        for record in self._timeline.values():
+            record.line = None
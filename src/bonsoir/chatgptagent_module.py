@@ -1,6 +1,5 @@
 import asyncio
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import heapq
 import json
@@ -9,55 +8,146 @@ from string import Template
 
 
 from itllib import Itl
-import openai
 
-from .chatagentbase_module import ChatAgentBaseModule
+from .chatagentbase_module import SUMMARY_PROMPT, ChatAgentBaseModule, summary_request
+from .openai_backend import OpenAIBackend
+from .response_cache import ResponseCache, cache_key
 
 
-DEFAULT_API_KEY = os.environ.get("OPENAI_API_KEY", None)
+def chat_summarizer(
+    model: str, backend: OpenAIBackend = None, prompt: str = SUMMARY_PROMPT
+):
+    """
+    A summarizer for ChatAgentBaseModule that uses an OpenAI chat model, which can
+    be cheaper than the one generating responses.
+    """
+
+    async def summarize(module, summary, lines):
+        chat_backend = backend
+        if chat_backend is None:
+            chat_backend = OpenAIBackend.for_key(os.environ.get("OPENAI_API_KEY", None))
+        response = await chat_backend.chat(
+            model,
+            [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": summary_request(summary, lines)},
+            ],
+        )
+        return response.choices[0].message.content.strip()
+
+    return summarize
 
 
 class ChatGPTAgentModule(ChatAgentBaseModule):
+    """
+    Generates responses with the OpenAI chat completions API. Modules that use the
+    same API key share one OpenAIBackend, and so its connection pool, concurrency
+    limit and rate limits. Pass backend to configure those limits or to use a
+    separate backend.
+
+    If a cache is given, responses are cached by model and rendered messages, and
+    identical concurrent requests share one API call.
+
+    For downstreams with a schema, requests set response_format so the API
+    enforces it. response_format can be "json_schema", "json_object" for models
+    that only support JSON mode, or None for models that support neither.
+    """
+
     def __init__(
-        self, itl: Itl, model: str, api_key=None, template_vars={}, *args, **kwargs
+        self,
+        itl: Itl,
+        model: str,
+        api_key=None,
+        template_vars={},
+        *args,
+        backend: OpenAIBackend = None,
+        cache: ResponseCache = None,
+        response_format: str = "json_schema",
+        **kwargs
     ):
         super().__init__(itl, *args, **kwargs)
 
         if api_key is None:
-            api_key = DEFAULT_API_KEY
+            api_key = os.environ.get("OPENAI_API_KEY", None)
+        if backend is None:
+            backend = OpenAIBackend.for_key(api_key)
 
         self.model = model
         self.api_key = api_key
         self.template_vars = template_vars
-        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.backend = backend
+        self.cache = cache
+        self.response_format = response_format
+        if not backend.metrics.enabled:
+            backend.metrics = self.metrics
 
-    async def generate_response(self, system_prompt, user_prompt):
+    def _render_messages(self, system_prompt, user_prompt):
         template_vars = {
-            "history": self.history,
+            "history": self.downstream_history(),
+            "summary": self.summary,
         }
         template_vars.update(self.template_vars)
 
         system_prompt = Template(system_prompt).substitute(template_vars)
         user_prompt = Template(user_prompt).substitute(template_vars)
 
-        orig_key = openai.api_key
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ]
 
-        try:
-            openai.api_key = self.api_key
-            loop = asyncio.get_running_loop()
+    def _request_options(self) -> dict:
+        schema = self.downstream_schema()
+        if schema == None or self.response_format == None:
+            return {}
+        if self.response_format == "json_object":
+            return {"response_format": {"type": "json_object"}}
+        return {
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": schema},
+            }
+        }
 
-            response = await loop.run_in_executor(
-                self.executor,
-                lambda: openai.ChatCompletion.create(
-                    model=self.model, messages=messages
-                ),
-            )
+    def _cache_key(self, messages, options):
+        if not options:
+            return cache_key(self.model, messages)
+        return cache_key(self.model, [messages, options])
 
-            return response.choices[0].message.content
+    async def _complete(self, messages, options):
+        response = await self.backend.chat(self.model, messages, **options)
+        return response.choices[0].message.content
 
-        finally:
-            openai.api_key = orig_key
+    async def generate_response(self, system_prompt, user_prompt):
+        messages = self._render_messages(system_prompt, user_prompt)
+        options = self._request_options()
+        if self.cache is None:
+            return await self._complete(messages, options)
+
+        key = self._cache_key(messages, options)
+        return await self.cache.get_or_create(
+            key, lambda: self._complete(messages, options), self._cacheable
+        )
+
+    async def generate_response_stream(self, system_prompt, user_prompt):
+        messages = self._render_messages(system_prompt, user_prompt)
+        options = self._request_options()
+
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(messages, options)
+            cached = self.cache.get(key)
+            if cached is not None and self._cacheable(cached):
+                self.cache.hits += 1
+                yield cached
+                return
+            self.cache.misses += 1
+
+        chunks = []
+        async for chunk in self.backend.chat_stream(self.model, messages, **options):
+            chunks.append(chunk)
+            yield chunk
+
+        response = "".join(chunks)
+        if key is not None and self._cacheable(response):
+            self.cache.set(key, response)
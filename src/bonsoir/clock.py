@@ -0,0 +1,144 @@
+import asyncio
+from datetime import datetime, timedelta
+import selectors
+import time
+
+
+class SystemClock:
+    """The real clock. now() gives wall clock time, monotonic() the loop's clock."""
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+
+system_clock = SystemClock()
+
+
+class VirtualClock:
+    """
+    A clock that only moves when advanced. VirtualEventLoop advances it straight to
+    each deadline instead of waiting.
+    """
+
+    def __init__(self, start: datetime = None):
+        self.start = start if start != None else datetime.now()
+        self.elapsed = 0.0
+
+    def now(self) -> datetime:
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def monotonic(self) -> float:
+        return self.elapsed
+
+    def advance(self, seconds: float):
+        if seconds > 0:
+            self.elapsed += seconds
+
+
+def get_clock():
+    """The clock for the running event loop, or the system clock."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return system_clock
+    return getattr(loop, "clock", system_clock)
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    Polls the real selector without blocking. If nothing is ready, the clock
+    jumps forward by the timeout the loop would have waited for.
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+    def select(self, timeout=None):
+        if timeout == None:
+            # Nothing is scheduled, so only another thread can wake the loop
+            return self._selector.select(None)
+        events = self._selector.select(0)
+        if not events:
+            self.clock.advance(timeout)
+        return events
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """
+    An event loop that runs on a VirtualClock. Whenever every task is waiting on
+    a timer, time jumps to the next deadline, so sleeps, the scheduler and module
+    intervals take no real time. Modules created on this loop use its clock for
+    message timestamps and rendered history.
+
+    Work done in other threads, like a real LlamaEngine, still takes real time, so
+    simulate against stub backends.
+    """
+
+    def __init__(self, clock: VirtualClock = None):
+        self.clock = clock if clock != None else VirtualClock()
+        super().__init__(_VirtualSelector(self.clock))
+
+    def time(self) -> float:
+        return self.clock.monotonic()
+
+
+def run_simulation(main, clock: VirtualClock = None):
+    """Like asyncio.run, but on a VirtualEventLoop."""
+    loop = VirtualEventLoop(clock)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            # Cancelled tasks can schedule more work while they clean up
+            tasks = asyncio.all_tasks(loop)
+            while tasks:
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                tasks = asyncio.all_tasks(loop)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+async def replay(transcript, deliver):
+    """
+    Deliver recorded messages at the times they were recorded. transcript is an
+    iterable of (when, stream, message) in order, where when is a datetime or a
+    number of seconds since the replay started. Each message is passed to
+    await deliver(stream, message).
+
+    On a VirtualEventLoop, start its clock at the first recorded datetime to
+    reproduce the original timeline.
+    """
+    clock = get_clock()
+    start = clock.monotonic()
+    for when, stream, message in transcript:
+        if isinstance(when, datetime):
+            delay = (when - clock.now()).total_seconds()
+        else:
+            delay = when - (clock.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await deliver(stream, message)
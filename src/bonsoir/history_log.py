@@ -0,0 +1,320 @@
+from contextlib import contextmanager
+import math
+import mmap
+import os
+import struct
+import zlib
+
+
+MESSAGE = 1
+INTERVALS = 2
+SUMMARY = 3
+
+SNAPSHOT_MAGIC = b"BONSNAP1"
+
+# length and crc32 of the body, then the entry type
+_HEADER = struct.Struct("<IIB")
+# timestamp, capacity, tokens, is_reference, then the lengths of the source,
+# name and payload that follow
+_MESSAGE = struct.Struct("<dIIBHHI")
+# default interval, current interval, last attempt, then the downstream's length
+_INTERVALS = struct.Struct("<dddH")
+# the number of messages folded, is_reference, then the lengths of the source
+# and summary that follow
+_SUMMARY = struct.Struct("<IBHI")
+# magic, then the first log segment not covered by the snapshot
+_SNAPSHOT_HEADER = struct.Struct("<8sQ")
+
+
+def _seconds(value) -> float:
+    return math.nan if value == None else value
+
+
+def _optional(value: float):
+    return None if math.isnan(value) else value
+
+
+def encode_message(
+    timestamp: float,
+    capacity: int,
+    tokens: int,
+    is_reference: bool,
+    source: str,
+    name: str,
+    payload: bytes,
+) -> bytes:
+    source = source.encode("utf-8")
+    name = name.encode("utf-8")
+    body = (
+        _MESSAGE.pack(
+            timestamp,
+            capacity,
+            tokens,
+            is_reference,
+            len(source),
+            len(name),
+            len(payload),
+        )
+        + source
+        + name
+        + payload
+    )
+    return _HEADER.pack(len(body), zlib.crc32(body), MESSAGE) + body
+
+
+def encode_intervals(
+    downstream: str, default: float, current: float, last_attempt: float
+) -> bytes:
+    downstream = downstream.encode("utf-8")
+    body = (
+        _INTERVALS.pack(
+            _seconds(default), _seconds(current), _seconds(last_attempt), len(downstream)
+        )
+        + downstream
+    )
+    return _HEADER.pack(len(body), zlib.crc32(body), INTERVALS) + body
+
+
+def encode_summary(count: int, is_reference: bool, source: str, summary: str) -> bytes:
+    source = source.encode("utf-8")
+    summary = summary.encode("utf-8")
+    body = (
+        _SUMMARY.pack(count, is_reference, len(source), len(summary)) + source + summary
+    )
+    return _HEADER.pack(len(body), zlib.crc32(body), SUMMARY) + body
+
+
+@contextmanager
+def _map(f):
+    """Map a file read-only, or give None if it's empty."""
+    if os.fstat(f.fileno()).st_size == 0:
+        yield None
+        return
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield buffer
+    finally:
+        buffer.close()
+
+
+def _decode(buffer, start: int, kind: int):
+    if kind == MESSAGE:
+        (
+            timestamp,
+            capacity,
+            tokens,
+            is_reference,
+            source_length,
+            name_length,
+            payload_length,
+        ) = _MESSAGE.unpack_from(buffer, start)
+        offset = start + _MESSAGE.size
+        source = buffer[offset : offset + source_length].decode("utf-8")
+        offset += source_length
+        name = buffer[offset : offset + name_length].decode("utf-8")
+        offset += name_length
+        payload = buffer[offset : offset + payload_length]
+        return (
+            MESSAGE,
+            timestamp,
+            capacity,
+            tokens,
+            bool(is_reference),
+            source,
+            name,
+            payload,
+        )
+    elif kind == INTERVALS:
+        default, current, last_attempt, length = _INTERVALS.unpack_from(buffer, start)
+        offset = start + _INTERVALS.size
+        downstream = buffer[offset : offset + length].decode("utf-8")
+        return (
+            INTERVALS,
+            downstream,
+            _optional(default),
+            _optional(current),
+            _optional(last_attempt),
+        )
+    elif kind == SUMMARY:
+        count, is_reference, source_length, summary_length = _SUMMARY.unpack_from(
+            buffer, start
+        )
+        offset = start + _SUMMARY.size
+        source = buffer[offset : offset + source_length].decode("utf-8")
+        offset += source_length
+        summary = buffer[offset : offset + summary_length].decode("utf-8")
+        return (SUMMARY, count, bool(is_reference), source, summary)
+    return None
+
+
+def _scan(buffer, offset: int):
+    """
+    Yield (end offset, entry) for each intact entry in buffer from offset. Stops
+    at the first truncated or corrupt entry. Unknown entries are given as None.
+    """
+    size = len(buffer)
+    while offset + _HEADER.size <= size:
+        length, crc, kind = _HEADER.unpack_from(buffer, offset)
+        start = offset + _HEADER.size
+        end = start + length
+        if end > size or zlib.crc32(buffer[start:end]) != crc:
+            return
+        yield end, _decode(buffer, start, kind)
+        offset = end
+
+
+class HistoryLog:
+    """
+    An append-only on-disk log of a module's history, summary and generation
+    intervals, stored in a directory.
+
+    Entries are appended to numbered segment files, starting a new segment every
+    segment_bytes. Every snapshot_every entries, the module writes a compact
+    snapshot of its current state, and the segments it covers are deleted.
+    Recovery maps the snapshot and the remaining segments and replays their
+    entries. Payloads are stored as the encoded messages along with their token
+    counts, so nothing is parsed or re-tokenized on startup.
+
+    Each entry is checksummed. A torn write at the end of the log is truncated
+    during recovery.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        segment_bytes: int = 16 * 1024 * 1024,
+        snapshot_every: int = 10000,
+        fsync: bool = False,
+    ):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.entries_since_snapshot = 0
+        os.makedirs(path, exist_ok=True)
+
+        self._segment = None
+        self._file = None
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.path, "snapshot.bin")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:08d}.log")
+
+    def _segments(self) -> list:
+        return sorted(
+            int(name[:-4])
+            for name in os.listdir(self.path)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+
+    @property
+    def due_for_snapshot(self) -> bool:
+        return self.entries_since_snapshot >= self.snapshot_every
+
+    def recover(self):
+        """
+        Yield the entries in the snapshot and the log, oldest first, then open the
+        log for appending.
+        """
+        first_segment = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f, _map(f) as buffer:
+                if buffer != None and len(buffer) >= _SNAPSHOT_HEADER.size:
+                    magic, first_segment = _SNAPSHOT_HEADER.unpack_from(buffer, 0)
+                    if magic != SNAPSHOT_MAGIC:
+                        raise ValueError(f"{self.snapshot_path} is not a snapshot")
+                    for _, entry in _scan(buffer, _SNAPSHOT_HEADER.size):
+                        if entry != None:
+                            yield entry
+
+        segments = [s for s in self._segments() if s >= first_segment]
+        for segment in segments:
+            path = self._segment_path(segment)
+            with open(path, "rb") as f, _map(f) as buffer:
+                if buffer == None:
+                    continue
+                end = 0
+                for end, entry in _scan(buffer, 0):
+                    self.entries_since_snapshot += 1
+                    if entry != None:
+                        yield entry
+                torn = end < len(buffer)
+            if torn:
+                os.truncate(path, end)
+
+        self._open(segments[-1] if segments else first_segment)
+
+    def _open(self, segment: int):
+        if self._file != None:
+            self._file.close()
+        self._segment = segment
+        self._file = open(self._segment_path(segment), "ab")
+
+    def _write(self, data: bytes):
+        if self._file == None:
+            segments = self._segments()
+            self._open(segments[-1] if segments else 0)
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.entries_since_snapshot += 1
+        if self._file.tell() >= self.segment_bytes:
+            self._open(self._segment + 1)
+
+    def append_message(
+        self,
+        timestamp: float,
+        capacity: int,
+        tokens: int,
+        is_reference: bool,
+        source: str,
+        name: str,
+        payload: bytes,
+    ):
+        self._write(
+            encode_message(
+                timestamp, capacity, tokens, is_reference, source, name, payload
+            )
+        )
+
+    def append_intervals(
+        self, downstream: str, default: float, current: float, last_attempt: float
+    ):
+        self._write(encode_intervals(downstream, default, current, last_attempt))
+
+    def append_summary(self, count: int, is_reference: bool, source: str, summary: str):
+        self._write(encode_summary(count, is_reference, source, summary))
+
+    def write_snapshot(self, entries):
+        """
+        Replace the snapshot with the given encoded entries, which should describe
+        the module's whole state, and delete the log segments it covers.
+        """
+        if self._file == None:
+            segments = self._segments()
+            self._open(segments[-1] if segments else 0)
+        # New entries go to a fresh segment that the snapshot doesn't cover
+        self._open(self._segment + 1)
+
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self._segment))
+            for entry in entries:
+                f.write(entry)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        for segment in self._segments():
+            if segment < self._segment:
+                os.remove(self._segment_path(segment))
+        self.entries_since_snapshot = 0
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,142 @@
+import asyncio
+from collections import deque
+import itertools
+
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+class IngestionQueue:
+    """
+    A bounded queue of messages from one upstream. Worker tasks run the module's
+    preprocessor on queued messages concurrently, but messages are accepted in
+    the order they arrived.
+
+    When the queue is full, new messages either wait for space ("block"), push
+    out the oldest queued message ("drop-oldest"), or are dropped
+    ("drop-newest").
+    """
+
+    def __init__(
+        self,
+        module,
+        upstream: str,
+        maxsize: int,
+        workers: int = 1,
+        overflow: str = "block",
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}"
+            )
+        self.module = module
+        self.upstream = upstream
+        self.maxsize = maxsize
+        self.workers = workers
+        self.overflow = overflow
+        self.dropped = 0
+
+        # Called with each message after it's accepted
+        self.on_accept = []
+
+        self._items = deque()  # type: deque[tuple[int, object]]
+        self._sequence = itertools.count()
+        self._results = {}  # type: dict[int, object]
+        self._next_commit = 0
+        self._changed = None
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def _report_depth(self):
+        self.module.metrics.set_gauge(
+            "bonsoir_ingestion_queue_depth", len(self._items), upstream=self.upstream
+        )
+
+    def _drop(self):
+        self.dropped += 1
+        self.module.metrics.increment(
+            "bonsoir_ingestion_dropped_total", upstream=self.upstream
+        )
+
+    async def put(self, data):
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+            self._tasks = [
+                asyncio.get_running_loop().create_task(self._work())
+                for _ in range(self.workers)
+            ]
+
+        async with self._changed:
+            if len(self._items) >= self.maxsize:
+                if self.overflow == "drop-newest":
+                    self._drop()
+                    return
+                elif self.overflow == "drop-oldest":
+                    seq, _ = self._items.popleft()
+                    self._results[seq] = None
+                    self._drop()
+                else:
+                    await self._changed.wait_for(
+                        lambda: len(self._items) < self.maxsize
+                    )
+
+            self._items.append((next(self._sequence), data))
+            self._report_depth()
+            self._changed.notify_all()
+
+        self._commit()
+
+    async def _work(self):
+        module = self.module
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._items)
+                seq, data = self._items.popleft()
+                self._report_depth()
+                self._changed.notify_all()
+
+            try:
+                with module.metrics.span("bonsoir_preprocess", upstream=self.upstream):
+                    data = await module.preprocessor(module, self.upstream, data)
+            except Exception as e:
+                self._report("Exception in preprocessor", e)
+                data = None
+
+            self._results[seq] = data
+            self._commit()
+
+    def _commit(self):
+        module = self.module
+        while self._next_commit in self._results:
+            data = self._results.pop(self._next_commit)
+            self._next_commit += 1
+            if data == None:
+                continue
+
+            # A message that can't be accepted is dropped, and the rest of the
+            # queue carries on
+            metadata = module.source_metadata[self.upstream]
+            try:
+                with module.metrics.span("bonsoir_accept", upstream=self.upstream):
+                    module.accept_message(self.upstream, metadata, data)
+                module._input_changed()
+            except Exception as e:
+                self._report("Exception in accept_message", e)
+                continue
+            for callback in self.on_accept:
+                try:
+                    callback(data)
+                except Exception as e:
+                    self._report("Exception in on_accept callback", e)
+
+    def _report(self, message: str, exception: Exception):
+        asyncio.get_running_loop().call_exception_handler(
+            {"message": message, "exception": exception}
+        )
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,278 @@
+import asyncio
+from collections import OrderedDict, deque
+import threading
+import time
+
+from .metrics import null_metrics
+
+
+class _Request:
+    __slots__ = (
+        "prompt",
+        "kwargs",
+        "stream",
+        "priority",
+        "client",
+        "loop",
+        "queue",
+        "cancelled",
+        "submitted",
+    )
+
+    def __init__(self, prompt, kwargs, stream, priority, client, loop):
+        self.prompt = prompt
+        self.kwargs = kwargs
+        self.stream = stream
+        self.priority = priority
+        self.client = client
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.cancelled = False
+        self.submitted = time.perf_counter()
+
+    def deliver(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # The requester's event loop is closed
+            self.cancelled = True
+
+
+_FINISHED = object()
+
+
+def _common_prefix(a, b) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class LlamaEngine:
+    """
+    Serves completions from a single llama.cpp model to any number of modules.
+    The model is only ever used from one worker thread, so modules sharing it
+    can't race on its state.
+
+    Requests are queued per client. The worker always serves the highest
+    priority first, and takes turns between clients with the same priority, so
+    one busy module can't starve the others.
+
+    Use for_llm or load to share an engine instead of creating one per module.
+
+    If state_cache_bytes is set, the engine saves the model state after each
+    generation and keeps an LRU of saved states under that many bytes. Before
+    each generation, it restores the saved state sharing the longest token
+    prefix with the new prompt, so llama.cpp only evaluates the part of the
+    prompt that changed.
+
+    Time spent queued is recorded in metrics as bonsoir_queue_wait_seconds, along
+    with token usage.
+    """
+
+    # Engines keep their model alive, so keying these by id is safe
+    _engines = {}  # type: dict[int, LlamaEngine]
+    _loaded = {}  # type: dict[tuple, LlamaEngine]
+
+    def __init__(self, llm, state_cache_bytes: int = None):
+        self.llm = llm
+        self.state_cache_bytes = state_cache_bytes
+        # id -> (tokens, state, size), ordered from least to most recently used
+        self._states = OrderedDict()  # type: OrderedDict[int, tuple]
+        self._state_bytes = 0
+        self._next_state_id = 0
+        # Measured from saved states, to skip saving states too large to keep
+        self._state_bytes_per_token = None
+        self.reused_tokens = 0
+        self.metrics = null_metrics
+        self._condition = threading.Condition()
+        # priority -> client -> requests, with clients in round-robin order
+        self._queues = {}  # type: dict[int, OrderedDict[object, deque[_Request]]]
+        self._thread = None
+        self._closed = False
+
+    @classmethod
+    def for_llm(cls, llm, **kwargs) -> "LlamaEngine":
+        """
+        Get the shared engine for a Llama instance. The kwargs configure the
+        engine if it doesn't exist yet.
+        """
+        engine = cls._engines.get(id(llm))
+        if engine is None:
+            engine = cls(llm, **kwargs)
+            cls._engines[id(llm)] = engine
+        return engine
+
+    @classmethod
+    def load(
+        cls, model_path: str, state_cache_bytes: int = None, **kwargs
+    ) -> "LlamaEngine":
+        """Load a model once per process and get its shared engine."""
+        key = (model_path, tuple(sorted(kwargs.items())))
+        engine = cls._loaded.get(key)
+        if engine is None:
+            from llama_cpp import Llama
+
+            llm = Llama(model_path=model_path, **kwargs)
+            engine = cls.for_llm(llm, state_cache_bytes=state_cache_bytes)
+            cls._loaded[key] = engine
+        return engine
+
+    @property
+    def pending(self) -> int:
+        with self._condition:
+            return sum(
+                len(requests)
+                for clients in self._queues.values()
+                for requests in clients.values()
+            )
+
+    def _submit(self, prompt, stream, priority, client, kwargs) -> _Request:
+        request = _Request(
+            prompt, kwargs, stream, priority, client, asyncio.get_running_loop()
+        )
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("LlamaEngine is closed")
+            clients = self._queues.setdefault(priority, OrderedDict())
+            clients.setdefault(client, deque()).append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return request
+
+    async def complete(self, prompt: str, priority: int = 0, client=None, **kwargs):
+        """
+        Run a completion and return llama.cpp's response. Higher priorities are
+        served first. Extra arguments are passed to the model call.
+        """
+        request = self._submit(prompt, False, priority, client, kwargs)
+        try:
+            result = await request.queue.get()
+        finally:
+            request.cancelled = True
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def stream(self, prompt: str, priority: int = 0, client=None, **kwargs):
+        """Run a completion and yield llama.cpp's response chunks as they arrive."""
+        request = self._submit(prompt, True, priority, client, kwargs)
+        try:
+            while True:
+                chunk = await request.queue.get()
+                if chunk is _FINISHED:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            request.cancelled = True
+
+    def _next_request(self) -> _Request:
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                for priority in sorted(self._queues, reverse=True):
+                    clients = self._queues[priority]
+                    client, requests = next(iter(clients.items()))
+                    request = requests.popleft()
+                    # Move this client to the back of the line
+                    del clients[client]
+                    if requests:
+                        clients[client] = requests
+                    if not clients:
+                        del self._queues[priority]
+                    return request
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            if request.cancelled:
+                continue
+
+            self.metrics.observe(
+                "bonsoir_queue_wait_seconds", time.perf_counter() - request.submitted
+            )
+            try:
+                if self.state_cache_bytes:
+                    self._restore_prefix(request.prompt)
+
+                if request.stream:
+                    for chunk in self.llm(request.prompt, stream=True, **request.kwargs):
+                        if request.cancelled:
+                            break
+                        request.deliver(chunk)
+                    request.deliver(_FINISHED)
+                else:
+                    response = self.llm(request.prompt, **request.kwargs)
+                    usage = response.get("usage")
+                    if usage:
+                        self.metrics.increment(
+                            "bonsoir_prompt_tokens_total", usage["prompt_tokens"]
+                        )
+                        self.metrics.increment(
+                            "bonsoir_completion_tokens_total",
+                            usage["completion_tokens"],
+                        )
+                    request.deliver(response)
+
+                if self.state_cache_bytes:
+                    self._save_state()
+            except Exception as e:
+                request.deliver(e)
+
+    def _restore_prefix(self, prompt: str):
+        tokens = self.llm.tokenize(prompt.encode("utf-8"))
+        # input_ids is n_ctx long, and only the first n_tokens are evaluated
+        current = _common_prefix(self.llm.input_ids[: self.llm.n_tokens], tokens)
+
+        best_id, best_length = None, current
+        for state_id, (state_tokens, _, _) in self._states.items():
+            length = _common_prefix(state_tokens, tokens)
+            if length > best_length:
+                best_id, best_length = state_id, length
+
+        if best_id != None:
+            self._states.move_to_end(best_id)
+            self.llm.load_state(self._states[best_id][1])
+        # llama.cpp skips evaluating the prefix it already has
+        self.reused_tokens += best_length
+
+    def _save_state(self):
+        if self._state_bytes_per_token != None:
+            estimate = self.llm.n_tokens * self._state_bytes_per_token
+            if estimate > self.state_cache_bytes:
+                return
+
+        state = self.llm.save_state()
+        tokens = list(state.input_ids[: state.n_tokens])
+        size = state.llama_state_size
+        self._state_bytes_per_token = size / max(state.n_tokens, 1)
+        if size > self.state_cache_bytes:
+            # It would only evict every other state, then itself
+            return
+
+        # Drop states that this one extends, since it can serve their prefixes
+        for state_id, (state_tokens, _, state_size) in list(self._states.items()):
+            if _common_prefix(state_tokens, tokens) == len(state_tokens):
+                del self._states[state_id]
+                self._state_bytes -= state_size
+
+        self._states[self._next_state_id] = (tokens, state, size)
+        self._next_state_id += 1
+        self._state_bytes += size
+        while self._state_bytes > self.state_cache_bytes and self._states:
+            _, (_, _, state_size) = self._states.popitem(last=False)
+            self._state_bytes -= state_size
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -1,6 +1,5 @@
 import asyncio
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import heapq
 import json
@@ -9,28 +8,146 @@ from string import Template
 
 from itllib import Itl
 
-from .chatagentbase_module import ChatAgentBaseModule
+from .chatagentbase_module import SUMMARY_PROMPT, ChatAgentBaseModule, summary_request
+from .llama_engine import LlamaEngine
+from .response_cache import ResponseCache, cache_key
+
+
+# Compiled grammars, keyed by the JSON schema they enforce
+_grammars = {}
+
+
+def llama_summarizer(
+    llm, prompt: str = SUMMARY_PROMPT, priority: int = -1, max_tokens: int = 256
+):
+    """
+    A summarizer for ChatAgentBaseModule that uses a llama.cpp model. The llm can
+    be a Llama instance or a LlamaEngine. Summaries are queued below responses by
+    default.
+    """
+    engine = llm if isinstance(llm, LlamaEngine) else LlamaEngine.for_llm(llm)
+
+    async def summarize(module, summary, lines):
+        response = await engine.complete(
+            f"{prompt.strip()}\n\n{summary_request(summary, lines)}\n\nUpdated summary:",
+            priority=priority,
+            client=id(summarize),
+            max_tokens=max_tokens,
+        )
+        return response["choices"][0]["text"].strip()
+
+    return summarize
 
 
 class LlamaCppModule(ChatAgentBaseModule):
-    def __init__(self, itl: Itl, llm, template_vars={}, *args, **kwargs):
+    """
+    Generates responses with a llama.cpp model. The llm can be a Llama instance
+    or a LlamaEngine. Either way, generations run on the model's shared engine,
+    so any number of modules can use the same model safely. Requests from this
+    module are queued with the given priority.
+
+    For downstreams with a schema, sampling is constrained with a grammar
+    generated from the schema, so the model can only produce matching JSON.
+    """
+
+    def __init__(
+        self,
+        itl: Itl,
+        llm,
+        template_vars={},
+        *args,
+        cache: ResponseCache = None,
+        priority: int = 0,
+        **kwargs
+    ):
         super().__init__(itl, *args, **kwargs)
-        self.llm = llm
+        if isinstance(llm, LlamaEngine):
+            self.engine = llm
+        else:
+            self.engine = LlamaEngine.for_llm(llm)
+        self.llm = self.engine.llm
+        if not self.engine.metrics.enabled:
+            self.engine.metrics = self.metrics
         self.template_vars = template_vars
-        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.cache = cache
+        self.priority = priority
 
-    async def generate_response(self, prompt):
+    @property
+    def model_name(self) -> str:
+        return getattr(self.llm, "model_path", None) or type(self.llm).__name__
+
+    def _render_prompt(self, prompt):
         template_vars = {
-            "history": self.history,
+            "history": self.downstream_history(),
+            "summary": self.summary,
         }
         template_vars.update(self.template_vars)
 
-        prompt = Template(prompt).substitute(template_vars)
+        return Template(prompt).substitute(template_vars)
 
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(
-            self.executor,
-            lambda: self.llm(prompt),
-        )
+    def _request_options(self) -> dict:
+        schema = self.downstream_schema()
+        if schema == None:
+            return {}
+
+        encoded = json.dumps(schema, sort_keys=True)
+        grammar = _grammars.get(encoded)
+        if grammar is None:
+            from llama_cpp import LlamaGrammar
 
+            grammar = LlamaGrammar.from_json_schema(encoded, verbose=False)
+            _grammars[encoded] = grammar
+        return {"grammar": grammar}
+
+    def _cache_key(self, prompt):
+        schema = self.downstream_schema()
+        if schema == None:
+            return cache_key(self.model_name, prompt)
+        return cache_key(self.model_name, [prompt, schema])
+
+    async def _complete(self, prompt, options):
+        response = await self.engine.complete(
+            prompt, priority=self.priority, client=id(self), **options
+        )
         return response["choices"][0]["text"]
+
+    async def generate_response(self, prompt):
+        prompt = self._render_prompt(prompt)
+        options = self._request_options()
+        if self.cache is None:
+            return await self._complete(prompt, options)
+
+        key = self._cache_key(prompt)
+        return await self.cache.get_or_create(
+            key, lambda: self._complete(prompt, options), self._cacheable
+        )
+
+    async def generate_response_stream(self, prompt):
+        prompt = self._render_prompt(prompt)
+        options = self._request_options()
+
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(prompt)
+            cached = self.cache.get(key)
+            if cached is not None and self._cacheable(cached):
+                self.cache.hits += 1
+                yield cached
+                return
+            self.cache.misses += 1
+
+        chunks = []
+        async for chunk in self._stream(prompt, options):
+            chunks.append(chunk)
+            yield chunk
+
+        response = "".join(chunks)
+        if key is not None and self._cacheable(response):
+            self.cache.set(key, response)
+
+    async def _stream(self, prompt, options):
+        chunks = self.engine.stream(
+            prompt, priority=self.priority, client=id(self), **options
+        )
+        async for chunk in chunks:
+            yield chunk["choices"][0]["text"]
@@ -0,0 +1,211 @@
+from collections import OrderedDict, deque
+import itertools
+import os
+import weakref
+
+
+# Approximate per-record cost on top of the payload: the slotted record, its
+# float timestamp and its slot in the ring buffer.
+RECORD_OVERHEAD = 96
+
+
+class MessageRecord:
+    """
+    A single stored message. The payload is the utf-8 encoded JSON message, and
+    the source is stored as an interned integer id.
+
+    The tokens, line and expires slots are owned by the module that accepted the
+    message. They hold the message's token count and a render cache.
+    """
+
+    __slots__ = (
+        "seq",
+        "timestamp",
+        "source_id",
+        "payload",
+        "tokens",
+        "line",
+        "expires",
+    )
+
+    def __init__(self, seq: int, timestamp: float, source_id: int, payload: bytes):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.source_id = source_id
+        self.payload = payload
+        self.tokens = 0
+        self.line = None
+        self.expires = None
+
+    @property
+    def nbytes(self):
+        return len(self.payload) + RECORD_OVERHEAD
+
+
+class SourceBuffer:
+    """
+    A bounded ring buffer of the messages from one source for one owner.
+    """
+
+    __slots__ = (
+        "owner_id",
+        "source_id",
+        "name",
+        "records",
+        "nbytes",
+    )
+
+    def __init__(self, owner_id: int, source_id: int):
+        self.owner_id = owner_id
+        self.source_id = source_id
+        self.name = None
+        self.records = deque()  # type: deque[MessageRecord]
+        self.nbytes = 0
+
+
+class MessageStore:
+    """
+    Holds the message buffers for any number of modules. Sources are interned so
+    each one is stored once no matter how many records refer to it.
+
+    If max_bytes is set, the store evicts whole sources, least recently active
+    first, whenever the total size of the stored messages exceeds it. The owner
+    of an evicted source is notified through its _forget_source method.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        self._source_ids = {}  # type: dict[object, int]
+        self._sources = {}  # type: dict[int, object]
+        self._source_refs = {}  # type: dict[int, int]
+        self._free_ids = []
+        self._next_source_id = itertools.count()
+
+        self._owners = {}  # type: dict[int, weakref.ref]
+        self._next_owner_id = itertools.count()
+
+        # Ordered from least to most recently active
+        self._buffers = OrderedDict()  # type: OrderedDict[tuple, SourceBuffer]
+        self._sequence = itertools.count()
+
+    def register(self, owner) -> int:
+        owner_id = next(self._next_owner_id)
+        self._owners[owner_id] = weakref.ref(owner)
+        weakref.finalize(owner, self.release, owner_id)
+        return owner_id
+
+    def release(self, owner_id: int):
+        """Drop every buffer belonging to an owner."""
+        self._owners.pop(owner_id, None)
+        for key in [key for key in self._buffers if key[0] == owner_id]:
+            buffer = self._drop(key)
+            self._release_source(buffer.source_id)
+
+    def intern(self, source) -> int:
+        source_id = self._source_ids.get(source)
+        if source_id is None:
+            if self._free_ids:
+                source_id = self._free_ids.pop()
+            else:
+                source_id = next(self._next_source_id)
+            self._source_ids[source] = source_id
+            self._sources[source_id] = source
+            self._source_refs[source_id] = 0
+        return source_id
+
+    def source(self, source_id: int):
+        return self._sources[source_id]
+
+    def buffer(self, owner_id: int, source) -> SourceBuffer:
+        """Get the buffer for a source, creating it if needed."""
+        source_id = self.intern(source)
+        key = (owner_id, source_id)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = SourceBuffer(owner_id, source_id)
+            self._buffers[key] = buffer
+            self._source_refs[source_id] += 1
+        return buffer
+
+    def append(
+        self, buffer: SourceBuffer, timestamp: float, payload: bytes, capacity: int
+    ) -> list:
+        """
+        Append a message to a buffer. Returns the records that were dropped from
+        the buffer to stay within its capacity.
+        """
+        record = MessageRecord(
+            next(self._sequence), timestamp, buffer.source_id, payload
+        )
+        buffer.records.append(record)
+        buffer.nbytes += record.nbytes
+        self.nbytes += record.nbytes
+        self._buffers.move_to_end((buffer.owner_id, buffer.source_id))
+
+        evicted = []
+        while len(buffer.records) > max(capacity, 1):
+            evicted.append(self._popleft(buffer))
+
+        self._enforce_budget()
+        return evicted
+
+    def drop_through(self, buffer: SourceBuffer, seq: int) -> list:
+        """Remove a buffer's oldest records, up to and including seq."""
+        dropped = []
+        while buffer.records and buffer.records[0].seq <= seq:
+            dropped.append(self._popleft(buffer))
+        return dropped
+
+    def _popleft(self, buffer: SourceBuffer) -> MessageRecord:
+        record = buffer.records.popleft()
+        buffer.nbytes -= record.nbytes
+        self.nbytes -= record.nbytes
+        return record
+
+    def _enforce_budget(self):
+        if self.max_bytes is None:
+            return
+
+        # Never evict the most recently active source
+        while self.nbytes > self.max_bytes and len(self._buffers) > 1:
+            key = next(iter(self._buffers))
+            buffer = self._drop(key)
+            owner_ref = self._owners.get(buffer.owner_id)
+            owner = owner_ref() if owner_ref else None
+            if owner is not None:
+                owner._forget_source(self._sources[buffer.source_id], buffer)
+            self._release_source(buffer.source_id)
+
+    def _drop(self, key) -> SourceBuffer:
+        buffer = self._buffers.pop(key)
+        self.nbytes -= buffer.nbytes
+        return buffer
+
+    def _release_source(self, source_id: int):
+        self._source_refs[source_id] -= 1
+        if self._source_refs[source_id] == 0:
+            source = self._sources.pop(source_id)
+            del self._source_ids[source]
+            del self._source_refs[source_id]
+            self._free_ids.append(source_id)
+
+
+def _default_max_bytes():
+    value = os.environ.get("BONSOIR_HISTORY_MAX_BYTES")
+    return int(value) if value else None
+
+
+# Shared by every module that isn't given a store. Its budget can be set with the
+# BONSOIR_HISTORY_MAX_BYTES environment variable or configure_default_store.
+default_store = MessageStore(max_bytes=_default_max_bytes())
+
+
+def configure_default_store(max_bytes: int = None):
+    """
+    Set the process-wide byte budget for the history of modules using the default
+    store, or remove it with None. Sources over the new budget are evicted now.
+    """
+    default_store.max_bytes = max_bytes
+    default_store._enforce_budget()
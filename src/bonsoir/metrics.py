@@ -0,0 +1,255 @@
+from bisect import bisect_left
+import time
+
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullMetrics:
+    """
+    The default metrics sink. Every hook is a no-op, so instrumentation costs a
+    method call when metrics are disabled. Hot paths can also check enabled.
+    """
+
+    enabled = False
+
+    def increment(self, name: str, value: float = 1, **labels):
+        pass
+
+    def set_gauge(self, name: str, value: float, **labels):
+        pass
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        pass
+
+    def observe(self, name: str, seconds: float, **labels):
+        pass
+
+    def span(self, name: str, **labels):
+        """Time a block of code, recording it in the {name}_seconds histogram."""
+        return _NULL_SPAN
+
+
+null_metrics = NullMetrics()
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name + "_seconds", elapsed, **self.labels)
+        if exc_type is not None:
+            self.metrics.increment(self.name + "_errors_total", **self.labels)
+        return False
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    formatted = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in items
+    )
+    return "{" + formatted + "}"
+
+
+class Metrics(NullMetrics):
+    """
+    Collects counters, gauges and latency histograms in process. Use
+    prometheus_text to export them, or snapshot and merge to combine metrics
+    from several processes.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}  # type: dict[tuple, float]
+        self.gauges = {}  # type: dict[tuple, float]
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}  # type: dict[tuple, list]
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[_key(name, labels)] = value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = _key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = [0] * (len(self.buckets) + 2)
+            self.histograms[key] = histogram
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def span(self, name: str, **labels):
+        return _Span(self, name, labels)
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": self.buckets,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {
+                key: list(histogram) for key, histogram in self.histograms.items()
+            },
+        }
+
+    def merge(self, snapshot: dict):
+        """Add the metrics from another Metrics' snapshot into this one."""
+        if tuple(snapshot["buckets"]) != self.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        for key, value in snapshot["counters"].items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, value in snapshot["gauges"].items():
+            self.gauges[key] = self.gauges.get(key, 0) + value
+        for key, other in snapshot["histograms"].items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                self.histograms[key] = list(other)
+            else:
+                for i, count in enumerate(other):
+                    histogram[i] += count
+
+    def prometheus_text(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                le = _format_labels(labels, [("le", bound)])
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            count = cumulative + histogram[-2]
+            le = _format_labels(labels, [("le", "+Inf")])
+            lines.append(f"{name}_bucket{le} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class _OpenTelemetrySpan(_Span):
+    __slots__ = ("span",)
+
+    def __init__(self, metrics, name, labels):
+        super().__init__(metrics, name, labels)
+        self.span = metrics.tracer.start_as_current_span(name, attributes=labels)
+
+    def __enter__(self):
+        self.span.__enter__()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        return self.span.__exit__(*exc_info)
+
+
+class OpenTelemetryMetrics(NullMetrics):
+    """
+    Forwards metrics to an OpenTelemetry meter, and spans to a tracer if one is
+    given. Instruments are created on first use.
+    """
+
+    enabled = True
+
+    def __init__(self, meter, tracer=None):
+        self.meter = meter
+        self.tracer = tracer
+        self._instruments = {}
+        self._gauge_values = {}
+
+    def _instrument(self, name, create):
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            instrument = create(name)
+            self._instruments[name] = instrument
+        return instrument
+
+    def increment(self, name: str, value: float = 1, **labels):
+        self._instrument(name, self.meter.create_counter).add(value, attributes=labels)
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        self.add_gauge(name, value - self._gauge_values.get(key, 0), **labels)
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = _key(name, labels)
+        self._gauge_values[key] = self._gauge_values.get(key, 0) + delta
+        counter = self._instrument(name, self.meter.create_up_down_counter)
+        counter.add(delta, attributes=labels)
+
+    def observe(self, name: str, seconds: float, **labels):
+        histogram = self._instrument(
+            name, lambda name: self.meter.create_histogram(name, unit="s")
+        )
+        histogram.record(seconds, attributes=labels)
+
+    def span(self, name: str, **labels):
+        if self.tracer is None:
+            return _Span(self, name, labels)
+        return _OpenTelemetrySpan(self, name, labels)
@@ -0,0 +1,194 @@
+import asyncio
+import time
+
+from .metrics import null_metrics
+
+
+def estimate_tokens(messages) -> int:
+    # Roughly 4 characters per token, plus a few tokens of overhead per message
+    return sum(len(message["content"]) // 4 + 4 for message in messages)
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at rate_per_minute and holds at
+    most one minute's worth of tokens.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        # Refills follow the event loop's clock, so they keep up in simulations
+        self.updated = None
+
+    def _refill(self):
+        now = asyncio.get_running_loop().time()
+        if self.updated == None:
+            self.updated = now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def refund(self, amount: float):
+        """Return unused tokens, or take more if amount is negative."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class OpenAIBackend:
+    """
+    An async OpenAI client for a single API key. Every module using the same key
+    should share one backend (see for_key) so they share its connection pool,
+    concurrency limit and rate limits.
+
+    - max_concurrency: The maximum number of requests in flight.
+    - requests_per_minute, tokens_per_minute: Client-side rate limits. Token
+      usage is estimated before each request and corrected once the response
+      reports its actual usage.
+    - max_tokens_estimate: The completion size to assume when a request doesn't
+      set max_tokens.
+
+    Time spent waiting on the rate limits and concurrency limit is recorded in
+    metrics as bonsoir_queue_wait_seconds, along with token usage.
+    """
+
+    _backends = {}  # type: dict[str, OpenAIBackend]
+
+    def __init__(
+        self,
+        api_key: str = None,
+        max_concurrency: int = 16,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        max_tokens_estimate: int = 512,
+        timeout: float = 600,
+        max_retries: int = 2,
+    ):
+        # Imported here so importing bonsoir doesn't load openai
+        import openai
+
+        self._openai = openai
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_tokens_estimate = max_tokens_estimate
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self.request_bucket = None
+        if requests_per_minute != None:
+            self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = None
+        if tokens_per_minute != None:
+            self.token_bucket = TokenBucket(tokens_per_minute)
+
+        # These are bound to an event loop, so they're created on first use
+        self._client = None
+        self._semaphore = None
+        self._loop = None
+        self.metrics = null_metrics
+
+    @classmethod
+    def for_key(cls, api_key: str = None, **kwargs) -> "OpenAIBackend":
+        """Get the shared backend for an API key, creating it if needed."""
+        backend = cls._backends.get(api_key)
+        if backend is None:
+            backend = cls(api_key, **kwargs)
+            cls._backends[api_key] = backend
+        return backend
+
+    @property
+    def client(self) -> "openai.AsyncOpenAI":
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # The client keeps a pool of keep-alive connections, and the semaphore
+            # keeps us from needing more than max_concurrency of them.
+            self._client = self._openai.AsyncOpenAI(
+                api_key=self.api_key,
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._client
+
+    async def _acquire(self, estimate: int):
+        if self.request_bucket != None:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket != None:
+            await self.token_bucket.acquire(estimate)
+
+    async def chat(self, model: str, messages: list, **kwargs):
+        """Create a chat completion. Extra arguments are passed to the API."""
+        client = self.client
+        estimate = estimate_tokens(messages) + kwargs.get(
+            "max_tokens", self.max_tokens_estimate
+        )
+        start = time.perf_counter()
+        await self._acquire(estimate)
+
+        async with self._semaphore:
+            self.metrics.observe(
+                "bonsoir_queue_wait_seconds", time.perf_counter() - start, model=model
+            )
+            response = await client.chat.completions.create(
+                model=model, messages=messages, **kwargs
+            )
+
+        if response.usage != None:
+            self._record_usage(model, estimate, response.usage)
+
+        return response
+
+    def _record_usage(self, model: str, estimate: int, usage):
+        self.metrics.increment(
+            "bonsoir_prompt_tokens_total", usage.prompt_tokens, model=model
+        )
+        self.metrics.increment(
+            "bonsoir_completion_tokens_total", usage.completion_tokens, model=model
+        )
+        if self.token_bucket != None:
+            self.token_bucket.refund(estimate - usage.total_tokens)
+
+    async def chat_stream(self, model: str, messages: list, **kwargs):
+        """Create a chat completion and yield its content as it arrives."""
+        client = self.client
+        estimate = estimate_tokens(messages) + kwargs.get(
+            "max_tokens", self.max_tokens_estimate
+        )
+        start = time.perf_counter()
+        await self._acquire(estimate)
+
+        async with self._semaphore:
+            self.metrics.observe(
+                "bonsoir_queue_wait_seconds", time.perf_counter() - start, model=model
+            )
+            # The final chunk reports usage, so the token bucket can be corrected
+            stream_options = dict(kwargs.pop("stream_options", None) or {})
+            stream_options["include_usage"] = True
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options=stream_options,
+                **kwargs
+            )
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) != None:
+                    self._record_usage(model, estimate, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    async def aclose(self):
+        if self._client != None:
+            await self._client.close()
+            self._client = None
+            self._loop = None
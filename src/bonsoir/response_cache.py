@@ -0,0 +1,230 @@
+import asyncio
+from collections import OrderedDict
+from datetime import timedelta
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from .clock import get_clock
+
+
+def cache_key(model: str, request) -> str:
+    """Hash a model name and a JSON-serializable request into a cache key."""
+    encoded = json.dumps([model, request], sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class _Inflight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class ResponseCache:
+    """
+    Caches generated responses by key. Concurrent requests for the same key are
+    merged, so only one of them calls the model.
+
+    Subclasses implement the storage with get and set.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self._inflight = {}  # type: dict[str, _Inflight]
+
+    def get(self, key: str):
+        raise NotImplementedError()
+
+    def set(self, key: str, value: str):
+        raise NotImplementedError()
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "merged": self.merged}
+
+    async def get_or_create(self, key: str, create, validate=None):
+        """
+        Return the cached value for key. If there is none, await create() to make
+        it, unless another caller is already doing so for the same key. If
+        validate is given, values it rejects are neither cached nor returned from
+        the cache, though a rejected new value is still returned.
+
+        create() runs in a task owned by the cache, so cancelling one caller
+        doesn't affect the others waiting on it. It's only cancelled once every
+        caller waiting for it has been.
+        """
+        value = self.get(key)
+        if value != None and (validate == None or validate(value)):
+            self.hits += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight != None:
+            self.merged += 1
+        else:
+            self.misses += 1
+            task = asyncio.get_running_loop().create_task(
+                self._create(key, create, validate)
+            )
+            inflight = _Inflight(task)
+            self._inflight[key] = inflight
+            task.add_done_callback(lambda task: self._finished(key, inflight))
+
+        inflight.waiters += 1
+        try:
+            return await asyncio.shield(inflight.task)
+        finally:
+            inflight.waiters -= 1
+            if inflight.waiters == 0 and not inflight.task.done():
+                # Every caller was cancelled, so nobody needs the response
+                inflight.task.cancel()
+                self._finished(key, inflight)
+
+    async def _create(self, key: str, create, validate):
+        value = await create()
+        if validate == None or validate(value):
+            self.set(key, value)
+        return value
+
+    def _finished(self, key: str, inflight: _Inflight):
+        if self._inflight.get(key) is inflight:
+            del self._inflight[key]
+
+
+class MemoryResponseCache(ResponseCache):
+    """
+    An in-process LRU cache. Entries expire after ttl, and the least recently
+    used entries are evicted once there are more than max_entries of them or they
+    take up more than max_bytes.
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, max_bytes: int = None, ttl: timedelta = None
+    ):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl.total_seconds() if ttl != None else None
+        self.nbytes = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, tuple[float, str]]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry == None:
+            return None
+
+        created, value = entry
+        if self.ttl != None and get_clock().monotonic() - created > self.ttl:
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (get_clock().monotonic(), value)
+        self.nbytes += len(value)
+
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes != None and self.nbytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        created, value = self._entries.pop(key)
+        self.nbytes -= len(value)
+
+
+class DiskResponseCache(ResponseCache):
+    """
+    An LRU cache stored as one file per entry in a local directory, so it
+    survives restarts and can be shared between processes on the same host.
+    Recency is tracked with file modification times.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 65536,
+        max_bytes: int = None,
+        ttl: timedelta = None,
+    ):
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl.total_seconds() if ttl != None else None
+        os.makedirs(path, exist_ok=True)
+
+        # key -> size, ordered from least to most recently used
+        self._index = OrderedDict()  # type: OrderedDict[str, int]
+        self.nbytes = 0
+        entries = []
+        for name in os.listdir(path):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(path, name))
+                entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.nbytes += size
+
+    def __len__(self):
+        return len(self._index)
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key: str):
+        if key not in self._index:
+            return None
+
+        filename = self._filename(key)
+        try:
+            with open(filename, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._remove(key)
+            return None
+
+        if self.ttl != None and time.time() - entry["created"] > self.ttl:
+            self._remove(key)
+            return None
+
+        os.utime(filename)
+        self._index.move_to_end(key)
+        return entry["value"]
+
+    def set(self, key: str, value: str):
+        encoded = json.dumps({"created": time.time(), "value": value})
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(encoded)
+        os.replace(temp_path, self._filename(key))
+
+        if key in self._index:
+            self.nbytes -= self._index.pop(key)
+        self._index[key] = len(encoded)
+        self.nbytes += len(encoded)
+
+        while len(self._index) > self.max_entries or (
+            self.max_bytes != None and self.nbytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._index)))
+
+    def _remove(self, key: str):
+        self.nbytes -= self._index.pop(key)
+        try:
+            os.remove(self._filename(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,334 @@
+import asyncio
+from collections import deque
+from datetime import timedelta
+import inspect
+import logging
+import random
+
+from itllib import Itl
+
+from .chatagentbase_module import ChatAgentBaseModule
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackendStats:
+    """
+    Latency, error and circuit breaker state for one of a router's backends.
+    Latencies are kept for the most recent window successful requests.
+    """
+
+    def __init__(self, name: str, module, weight: float, window: int):
+        self.name = name
+        self.module = module
+        self.weight = weight
+        self.latencies = deque(maxlen=window)  # type: deque[float]
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened_at = None  # type: float
+        self.probing = False
+
+        parameters = inspect.signature(module.generate_response).parameters.values()
+        if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters):
+            self.accepts = None
+        else:
+            self.accepts = {
+                p.name
+                for p in parameters
+                if p.kind
+                in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)
+            }
+
+    def percentile(self, fraction: float) -> float:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    @property
+    def error_rate(self) -> float:
+        return self.failures / self.requests if self.requests else 0
+
+    def metadata_for(self, metadata: dict) -> dict:
+        """Keep only the downstream metadata that this backend accepts."""
+        if self.accepts == None:
+            return metadata
+        return {key: value for key, value in metadata.items() if key in self.accepts}
+
+
+class RouterModule(ChatAgentBaseModule):
+    """
+    Generates responses with a weighted pool of other modules, such as a
+    ChatGPTAgentModule and a LlamaCppModule. Messages stored by the router,
+    including history recovered from its history log, are forwarded to every
+    backend so each has the full history. Each downstream's metadata is passed to
+    a backend's generate_response filtered down to the arguments it accepts.
+
+    Each request goes to a backend chosen at random by weight. If it hasn't
+    finished once it passes that backend's hedge_percentile latency, a hedged
+    request is sent to another backend, and whichever finishes first wins. The
+    other is cancelled. Until a backend has min_samples latencies, hedge_after is
+    used instead, or no hedge if that's None. If a request fails, the next backend
+    is tried.
+
+    A backend that fails failure_threshold times in a row is taken out of the
+    pool for reset_timeout, then a single request is let through to probe it.
+
+    Streamed responses aren't hedged, but fall back to another backend if one
+    fails before producing any output.
+    """
+
+    def __init__(
+        self,
+        itl: Itl,
+        backends: list,
+        *args,
+        hedge_percentile: float = 0.95,
+        hedge_after: timedelta = None,
+        min_samples: int = 20,
+        window: int = 200,
+        failure_threshold: int = 5,
+        reset_timeout: timedelta = timedelta(seconds=30),
+        **kwargs
+    ):
+        # Set before the base class recovers history, which is forwarded to them
+        self.backends = []  # type: list[BackendStats]
+        names = set()
+        for backend in backends:
+            module, weight = backend if isinstance(backend, tuple) else (backend, 1)
+            name = (
+                getattr(module, "model", None)
+                or getattr(module, "model_name", None)
+                or type(module).__name__
+            )
+            unique_name, i = name, 1
+            while unique_name in names:
+                i += 1
+                unique_name = f"{name}-{i}"
+            names.add(unique_name)
+            self.backends.append(BackendStats(unique_name, module, weight, window))
+
+        super().__init__(itl, *args, **kwargs)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after.total_seconds() if hedge_after != None else None
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout.total_seconds()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            backend.name: {
+                "requests": backend.requests,
+                "failures": backend.failures,
+                "error_rate": backend.error_rate,
+                "p50": backend.percentile(0.5),
+                "p99": backend.percentile(0.99),
+                "open": backend.opened_at != None,
+            }
+            for backend in self.backends
+        }
+
+    def add_downstream(self, downstream: str, history_tokens: int = None, **kwargs):
+        super().add_downstream(downstream, history_tokens=history_tokens, **kwargs)
+        # Backends render history and enforce schemas for the router's downstreams
+        for backend in self.backends:
+            options = backend.module.dest_options[downstream]
+            options["history_tokens"] = history_tokens
+            options["schema"] = self.dest_options[downstream]["schema"]
+
+    def _store_message(
+        self,
+        source,
+        name,
+        timestamp: float,
+        encoded_message: bytes,
+        capacity: int,
+        tokens: int = None,
+    ):
+        record = super()._store_message(
+            source, name, timestamp, encoded_message, capacity, tokens
+        )
+        # This covers history recovered from the log as well as new messages.
+        # Backends count tokens with their own tokenizers.
+        for backend in self.backends:
+            backend.module._store_message(
+                source, name, timestamp, encoded_message, capacity
+            )
+        return record
+
+    def _fold(self, source, count: int, summary: str):
+        super()._fold(source, count, summary)
+        # Backends render ${summary} and the history from their own state
+        for backend in self.backends:
+            backend.module._fold(source, count, summary)
+
+    def timeskip(self, interval: timedelta):
+        super().timeskip(interval)
+        for backend in self.backends:
+            backend.module.timeskip(interval)
+
+    def _available(self, backend: BackendStats, now: float) -> bool:
+        if backend.opened_at == None:
+            return True
+        # Let one request through to probe a backend once its timeout passes
+        return not backend.probing and now - backend.opened_at >= self.reset_timeout
+
+    def _choose(self, exclude) -> BackendStats:
+        now = asyncio.get_running_loop().time()
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend not in exclude and self._available(backend, now)
+        ]
+        if not candidates:
+            return None
+        backend = random.choices(
+            candidates, weights=[backend.weight for backend in candidates]
+        )[0]
+        if backend.opened_at != None:
+            backend.probing = True
+        return backend
+
+    def _hedge_delay(self, backend: BackendStats) -> float:
+        if len(backend.latencies) < self.min_samples:
+            return self.hedge_after
+        return backend.percentile(self.hedge_percentile)
+
+    def _record_success(self, backend: BackendStats, elapsed: float):
+        backend.requests += 1
+        backend.latencies.append(elapsed)
+        backend.consecutive_failures = 0
+        if backend.opened_at != None:
+            logger.info("closing circuit for backend %s", backend.name)
+            backend.opened_at = None
+            self.metrics.set_gauge(
+                "bonsoir_backend_circuit_open", 0, backend=backend.name
+            )
+        backend.probing = False
+        self.metrics.observe(
+            "bonsoir_backend_request_seconds", elapsed, backend=backend.name
+        )
+
+    def _record_failure(self, backend: BackendStats, error: Exception):
+        backend.requests += 1
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        self.metrics.increment("bonsoir_backend_errors_total", backend=backend.name)
+        logger.warning("backend %s failed: %r", backend.name, error)
+        if backend.probing or (
+            backend.consecutive_failures >= self.failure_threshold
+            and backend.opened_at == None
+        ):
+            logger.warning("opening circuit for backend %s", backend.name)
+            backend.opened_at = asyncio.get_running_loop().time()
+            self.metrics.set_gauge(
+                "bonsoir_backend_circuit_open", 1, backend=backend.name
+            )
+        backend.probing = False
+
+    async def _call(self, backend: BackendStats, metadata: dict):
+        # Latencies are measured on the loop's clock, like the hedge timeouts
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            result = await backend.module.generate_response(
+                **backend.metadata_for(metadata)
+            )
+        except asyncio.CancelledError:
+            # Losing a hedge says nothing about the backend's health
+            backend.probing = False
+            raise
+        except Exception as e:
+            self._record_failure(backend, e)
+            raise
+        self._record_success(backend, loop.time() - start)
+        return result
+
+    async def generate_response(self, **metadata):
+        loop = asyncio.get_running_loop()
+        tasks = {}  # type: dict[asyncio.Task, BackendStats]
+        tried = []
+        hedged = False
+        error = None
+
+        backend = self._choose(tried)
+        try:
+            while True:
+                if backend != None:
+                    tried.append(backend)
+                    tasks[loop.create_task(self._call(backend, metadata))] = backend
+                if not tasks:
+                    if error != None:
+                        raise error
+                    raise RuntimeError("No backends are available")
+
+                timeout = None
+                if not hedged and len(tasks) == 1:
+                    timeout = self._hedge_delay(next(iter(tasks.values())))
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Let a request finishing right at the deadline complete. It
+                    # hasn't passed the percentile, and on a VirtualEventLoop
+                    # constant latencies land exactly on it.
+                    await asyncio.sleep(0)
+                    done = {task for task in tasks if task.done()}
+
+                if not done:
+                    hedged = True
+                    backend = self._choose(tried)
+                    if backend != None:
+                        self.metrics.increment(
+                            "bonsoir_backend_hedges_total", backend=backend.name
+                        )
+                    continue
+
+                for task in done:
+                    del tasks[task]
+                    if task.exception() == None:
+                        return task.result()
+                    error = task.exception()
+
+                # Fall back to another backend, unless one is still running
+                backend = self._choose(tried) if not tasks else None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def generate_response_stream(self, **metadata):
+        loop = asyncio.get_running_loop()
+        tried = []
+        error = None
+        while True:
+            backend = self._choose(tried)
+            if backend == None:
+                if error != None:
+                    raise error
+                raise RuntimeError("No backends are available")
+            tried.append(backend)
+
+            started = False
+            start = loop.time()
+            try:
+                chunks = backend.module.generate_response_stream(
+                    **backend.metadata_for(metadata)
+                )
+                async for chunk in chunks:
+                    started = True
+                    yield chunk
+            except asyncio.CancelledError:
+                backend.probing = False
+                raise
+            except Exception as e:
+                self._record_failure(backend, e)
+                if started:
+                    raise
+                error = e
+                continue
+
+            self._record_success(backend, loop.time() - start)
+            return
@@ -0,0 +1,288 @@
+import asyncio
+from bisect import bisect
+import hashlib
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import time
+
+from .metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModuleSpec:
+    """
+    A picklable description of a module: how to construct it, and the builder
+    calls to make on it. The builder methods mirror the module's and record the
+    call instead of making it, so a spec can be declared once in the parent
+    process and built in a worker.
+
+    The factory is a module class or an import path like "bonsoir:ChatGPTAgentModule".
+    It's called as factory(itl, *args, **kwargs). Everything passed to the spec
+    must be picklable, so preprocessors and postprocessors should be top-level
+    functions.
+    """
+
+    def __init__(self, name: str, factory, *args, **kwargs):
+        self.name = name
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.calls = []  # type: list[tuple[str, tuple, dict]]
+        self.upstreams = []  # type: list[str]
+
+    def _record(self, method, *args, **kwargs):
+        self.calls.append((method, args, kwargs))
+        return self
+
+    def add_upstream(self, upstream: str, **kwargs):
+        self.upstreams.append(upstream)
+        return self._record("add_upstream", upstream, **kwargs)
+
+    def add_downstream(self, downstream: str, **kwargs):
+        return self._record("add_downstream", downstream, **kwargs)
+
+    def add_downstream_group(self, group: str, downstreams: list, **kwargs):
+        return self._record("add_downstream_group", group, list(downstreams), **kwargs)
+
+    def add_reaction(self, upstream: str, downstream: str, **kwargs):
+        return self._record("add_reaction", upstream, downstream, **kwargs)
+
+    def set_generate_interval(self, downstream: str, interval, **kwargs):
+        return self._record("set_generate_interval", downstream, interval, **kwargs)
+
+    def add_periodic_response(self, seconds: float, downstream: str):
+        return self._record("add_periodic_response", seconds, downstream)
+
+    @property
+    def shard_key(self) -> str:
+        """Modules are routed by their first upstream, or by name if they have none."""
+        if self.upstreams:
+            return self.upstreams[0]
+        return self.name
+
+    def _resolve_factory(self):
+        if not isinstance(self.factory, str):
+            return self.factory
+        module_name, _, attribute = self.factory.partition(":")
+        return getattr(importlib.import_module(module_name), attribute)
+
+    async def build(self, itl, metrics=None):
+        factory = self._resolve_factory()
+        kwargs = dict(self.kwargs)
+        if metrics is not None:
+            kwargs.setdefault("metrics", metrics)
+
+        module = factory(itl, *self.args, **kwargs)
+        for method, args, call_kwargs in self.calls:
+            result = getattr(module, method)(*args, **call_kwargs)
+            if inspect.isawaitable(result):
+                await result
+        return module
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing over a set of nodes. Adding or removing a node only moves
+    the keys that hashed to it.
+    """
+
+    def __init__(self, nodes, replicas: int = 128):
+        self.replicas = replicas
+        self._ring = sorted(
+            (_hash(f"{node}:{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in self._ring]
+
+    def node_for(self, key: str):
+        index = bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+def _run_worker(worker_id, specs, config_path, secrets_path, metrics_queue, interval):
+    asyncio.run(
+        _worker_main(
+            worker_id, specs, config_path, secrets_path, metrics_queue, interval
+        )
+    )
+
+
+async def _worker_main(
+    worker_id, specs, config_path, secrets_path, metrics_queue, interval
+):
+    from itllib import Itl
+
+    itl = Itl()
+    itl.apply_config(config_path, secrets_path)
+
+    metrics = Metrics()
+    modules = [await spec.build(itl, metrics=metrics) for spec in specs]
+    itl.start_thread()
+
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            metrics_queue.put((worker_id, metrics.snapshot()))
+    finally:
+        itl.stop_itl()
+
+
+class ShardedRuntime:
+    """
+    Runs module specs across a pool of worker processes. Each module is assigned
+    to a worker by consistent hashing on its shard key (its first upstream), and
+    each worker builds its modules on its own event loop and itllib connection.
+
+    The parent supervises the workers: a worker that exits is restarted with
+    exponential backoff, and each worker periodically sends its metrics, which
+    are combined in metrics().
+    """
+
+    def __init__(
+        self,
+        config_path: str,
+        secrets_path: str,
+        workers: int = None,
+        metrics_interval: float = 5,
+        restart_backoff: float = 1,
+        max_restart_backoff: float = 60,
+    ):
+        self.config_path = config_path
+        self.secrets_path = secrets_path
+        self.workers = workers or os.cpu_count() or 1
+        self.metrics_interval = metrics_interval
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+
+        self.specs = []  # type: list[ModuleSpec]
+        self.ring = HashRing(range(self.workers))
+        self.restarts = {}  # type: dict[int, int]
+
+        self._context = multiprocessing.get_context("spawn")
+        self._metrics_queue = self._context.Queue()
+        self._processes = {}  # type: dict[int, multiprocessing.Process]
+        self._started_at = {}  # type: dict[int, float]
+        self._backoff = {}  # type: dict[int, float]
+        self._restart_at = {}  # type: dict[int, float]
+        self._snapshots = {}  # type: dict[int, dict]
+        self._stopping = False
+
+    def add(self, spec: ModuleSpec) -> ModuleSpec:
+        if any(existing.name == spec.name for existing in self.specs):
+            raise ValueError(f"Module {spec.name} already exists")
+        self.specs.append(spec)
+        return spec
+
+    def assignments(self) -> dict:
+        """Map each worker to the specs it runs."""
+        result = {worker_id: [] for worker_id in range(self.workers)}
+        for spec in self.specs:
+            result[self.ring.node_for(spec.shard_key)].append(spec)
+        return result
+
+    def _start_worker(self, worker_id: int, specs: list):
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                worker_id,
+                specs,
+                self.config_path,
+                self.secrets_path,
+                self._metrics_queue,
+                self.metrics_interval,
+            ),
+            name=f"bonsoir-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+
+    def start(self):
+        for worker_id, specs in self.assignments().items():
+            if specs:
+                self._start_worker(worker_id, specs)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        assignments = None
+        for worker_id, process in list(self._processes.items()):
+            if process.is_alive() or self._stopping:
+                continue
+
+            restart_at = self._restart_at.get(worker_id)
+            if restart_at is None:
+                # Back off if the worker died soon after starting
+                backoff = self._backoff.get(worker_id, 0)
+                if now - self._started_at[worker_id] < self.max_restart_backoff:
+                    backoff = min(
+                        max(backoff * 2, self.restart_backoff),
+                        self.max_restart_backoff,
+                    )
+                else:
+                    backoff = 0
+                self._backoff[worker_id] = backoff
+                self._restart_at[worker_id] = now + backoff
+                logger.warning(
+                    "worker %s exited with code %s, restarting in %s seconds",
+                    worker_id,
+                    process.exitcode,
+                    backoff,
+                )
+            elif now >= restart_at:
+                del self._restart_at[worker_id]
+                self._snapshots.pop(worker_id, None)
+                self.restarts[worker_id] = self.restarts.get(worker_id, 0) + 1
+                if assignments is None:
+                    assignments = self.assignments()
+                self._start_worker(worker_id, assignments[worker_id])
+
+    def _drain_metrics(self):
+        while True:
+            try:
+                worker_id, snapshot = self._metrics_queue.get_nowait()
+            except Exception:
+                return
+            self._snapshots[worker_id] = snapshot
+
+    def metrics(self) -> Metrics:
+        """The latest metrics from all workers, combined."""
+        self._drain_metrics()
+        result = Metrics()
+        for snapshot in self._snapshots.values():
+            result.merge(snapshot)
+        return result
+
+    async def supervise(self, poll_interval: float = 1):
+        """Keep the workers running until stop is called."""
+        while not self._stopping:
+            self._check_workers()
+            self._drain_metrics()
+            await asyncio.sleep(poll_interval)
+
+    def stop(self, timeout: float = 10):
+        self._stopping = True
+        for process in self._processes.values():
+            process.terminate()
+        for process in self._processes.values():
+            process.join(timeout)
+
+    def run(self):
+        """Start the workers and supervise them until interrupted."""
+        self.start()
+        try:
+            asyncio.run(self.supervise())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
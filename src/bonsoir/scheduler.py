@@ -0,0 +1,151 @@
+import asyncio
+import heapq
+import itertools
+import weakref
+
+from .metrics import null_metrics
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "_scheduler")
+
+    def __init__(self, scheduler: "Scheduler", deadline: float, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.callback = None
+        self.args = None
+        if self._scheduler is not None:
+            self._scheduler._timer_cancelled()
+            self._scheduler = None
+
+
+class Scheduler:
+    """
+    A deadline heap driven by a single task. Timers are plain callbacks, so
+    scheduling one costs a heap push, and the driver task only wakes up when the
+    earliest deadline passes or an earlier timer is added. With no timers, the
+    driver sleeps until one is scheduled.
+
+    Deadlines use the event loop's clock (loop.time()). If metrics are enabled,
+    the delay between each deadline and its callback running is recorded as
+    bonsoir_scheduler_lag_seconds.
+    """
+
+    _schedulers = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self._loop = loop
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._wakeup = None
+        self._task = None
+        self.metrics = null_metrics
+
+    @classmethod
+    def for_loop(cls, loop: asyncio.AbstractEventLoop = None) -> "Scheduler":
+        """Get the shared scheduler for an event loop, defaulting to the running one."""
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        scheduler = cls._schedulers.get(loop)
+        if scheduler is None:
+            scheduler = cls(loop)
+            cls._schedulers[loop] = scheduler
+        return scheduler
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop
+
+    def time(self) -> float:
+        return self.loop.time()
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_later(self, delay: float, callback, *args) -> TimerHandle:
+        return self.call_at(self.time() + max(delay, 0), callback, *args)
+
+    def call_at(self, deadline: float, callback, *args) -> TimerHandle:
+        handle = TimerHandle(self, deadline, callback, args)
+        earliest = not self._heap or deadline < self._heap[0][0]
+        heapq.heappush(self._heap, (deadline, next(self._sequence), handle))
+
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+        elif earliest:
+            self._wake()
+
+        return handle
+
+    def _timer_cancelled(self):
+        self._cancelled += 1
+
+        # Don't let cancelled timers pile up behind long deadlines
+        if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+            self._heap = [item for item in self._heap if not item[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def _run(self):
+        while True:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+
+            self._wakeup = self.loop.create_future()
+            if not self._heap:
+                await self._wakeup
+                continue
+
+            now = self.time()
+            delay = self._heap[0][0] - now
+            if delay > 0:
+                await asyncio.wait([self._wakeup], timeout=delay)
+                continue
+
+            # Only run the timers that are due now. Timers their callbacks arm
+            # wait until other tasks have had a turn, so a callback that keeps
+            # rescheduling itself can't starve the loop.
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                handle = heapq.heappop(self._heap)[2]
+                if handle.cancelled:
+                    self._cancelled -= 1
+                else:
+                    # Off the heap, so cancelling it no longer counts against it
+                    handle._scheduler = None
+                    due.append(handle)
+            for handle in due:
+                if handle.cancelled:
+                    # Cancelled by an earlier callback in this batch
+                    continue
+                self.metrics.observe(
+                    "bonsoir_scheduler_lag_seconds", now - handle.deadline
+                )
+                callback, args = handle.callback, handle.args
+                handle.cancel()
+                try:
+                    callback(*args)
+                except Exception as e:
+                    self.loop.call_exception_handler(
+                        {
+                            "message": "Exception in scheduled callback",
+                            "exception": e,
+                        }
+                    )
+            await asyncio.sleep(0)
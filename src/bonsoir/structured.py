@@ -0,0 +1,179 @@
+import json
+import re
+
+
+class StructuredOutputError(ValueError):
+    """A generation didn't match its downstream's schema."""
+
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+def _is_type(value, name: str) -> bool:
+    if name == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if name == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, _TYPES[name])
+
+
+def validate(value, schema: dict, path: str = "$"):
+    """
+    Check a parsed value against a JSON schema, raising StructuredOutputError if
+    it doesn't match. This covers the subset of JSON schema that's useful for
+    describing generations: type, enum, const, properties, required,
+    additionalProperties, items, minLength, maxLength, minimum, maximum, anyOf and
+    oneOf.
+    """
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        if not any(_is_type(value, name) for name in types):
+            raise StructuredOutputError(f"{path} should be of type {schema['type']}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise StructuredOutputError(f"{path} should be one of {schema['enum']}")
+    if "const" in schema and value != schema["const"]:
+        raise StructuredOutputError(f"{path} should be {schema['const']!r}")
+
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in value:
+                raise StructuredOutputError(f"{path} is missing {key}")
+        for key, item in value.items():
+            if key in properties:
+                validate(item, properties[key], f"{path}.{key}")
+            elif schema.get("additionalProperties") is False:
+                raise StructuredOutputError(f"{path} has unexpected key {key}")
+    elif isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            validate(item, schema["items"], f"{path}[{i}]")
+    elif isinstance(value, str):
+        if len(value) < schema.get("minLength", 0):
+            raise StructuredOutputError(f"{path} is too short")
+        if "maxLength" in schema and len(value) > schema["maxLength"]:
+            raise StructuredOutputError(f"{path} is too long")
+    elif _is_type(value, "number"):
+        if "minimum" in schema and value < schema["minimum"]:
+            raise StructuredOutputError(f"{path} should be at least {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            raise StructuredOutputError(f"{path} should be at most {schema['maximum']}")
+
+    if "anyOf" in schema:
+        if not any(_matches(value, option, path) for option in schema["anyOf"]):
+            raise StructuredOutputError(f"{path} doesn't match any allowed schema")
+    if "oneOf" in schema:
+        matches = sum(_matches(value, option, path) for option in schema["oneOf"])
+        if matches != 1:
+            raise StructuredOutputError(f"{path} should match exactly one schema")
+
+
+def _matches(value, schema: dict, path: str) -> bool:
+    try:
+        validate(value, schema, path)
+        return True
+    except StructuredOutputError:
+        return False
+
+
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+def repair(text: str) -> str:
+    """
+    Fix the common ways a model wraps or mangles JSON: surrounding prose or code
+    fences, and trailing commas.
+    """
+    start = min(
+        (i for i in (text.find("{"), text.find("[")) if i != -1), default=-1
+    )
+    end = max(text.rfind("}"), text.rfind("]"))
+    if start == -1 or end < start:
+        return text
+    return _TRAILING_COMMA.sub(r"\1", text[start : end + 1])
+
+
+def parse_structured(text: str, schema: dict):
+    """
+    Parse and validate a generation, repairing it locally if needed so a small
+    formatting mistake doesn't cost another generation.
+    """
+    try:
+        value = json.loads(text)
+    except ValueError:
+        try:
+            value = json.loads(repair(text))
+        except ValueError as e:
+            raise StructuredOutputError(f"Invalid JSON: {e}") from e
+    validate(value, schema)
+    return value
+
+
+def is_container_schema(schema: dict) -> bool:
+    """Whether a schema only allows objects and arrays at the top level."""
+    types = schema.get("type")
+    if types == None:
+        return False
+    if not isinstance(types, list):
+        types = [types]
+    return all(name in ("object", "array") for name in types)
+
+
+class JSONStreamParser:
+    """
+    Follows a streamed JSON object or array as it's generated. feed reports when
+    the top-level value is complete, so generation can stop there, and raises
+    StructuredOutputError as soon as the stream can't contain one.
+
+    Up to max_preamble characters before the value are tolerated, for code fences
+    and the like from backends that can't constrain their output. Only use it for
+    schemas where is_container_schema is true.
+    """
+
+    def __init__(self, max_preamble: int = 32):
+        self.max_preamble = max_preamble
+        self.preamble = 0
+        self.depth = 0
+        self.started = False
+        self.done = False
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> int:
+        """
+        Consume a chunk. Returns the length of the chunk up to the end of the
+        value if this chunk completes it, or None.
+        """
+        for i, c in enumerate(chunk):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+            elif not self.started:
+                if c in "{[":
+                    self.started = True
+                    self.depth = 1
+                elif not c.isspace():
+                    self.preamble += 1
+                    if self.preamble > self.max_preamble:
+                        raise StructuredOutputError(
+                            "Generation doesn't start with a JSON value"
+                        )
+            elif c == '"':
+                self._in_string = True
+            elif c in "{[":
+                self.depth += 1
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    return i + 1
+        return None
@@ -0,0 +1,36 @@
+class ApproximateTokenizer:
+    """
+    Estimates token counts from text length, at about 4 characters per token.
+    This is fast and needs no dependencies, but it's only a rough estimate.
+    """
+
+    def __init__(self, chars_per_token: float = 4):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token) + 1
+
+
+class TiktokenTokenizer:
+    """Counts tokens with tiktoken, for OpenAI models."""
+
+    def __init__(self, model: str = None, encoding: str = "cl100k_base"):
+        import tiktoken
+
+        if model != None:
+            self.encoding = tiktoken.encoding_for_model(model)
+        else:
+            self.encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+
+class LlamaTokenizer:
+    """Counts tokens with a llama.cpp model's own tokenizer."""
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def count(self, text: str) -> int:
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))